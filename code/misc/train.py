@@ -1,25 +1,31 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
 import sys
 sys.path.append('.')
+# the episode profiler of the playgrounds, appended last so that it does not shadow these modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'report-specific',
+                             'qAgentsPlaygrounds'))
 import pandas as pd
 import numpy as np
 import warnings
 import agents
 from agents import Seller, Buyer
 from environments import MarketEnvironment
+from profiling import EpisodeProfiler
 
 
 import info_settings
 import matchers
 
 # Utility functions
-def get_state(agent_id, market):
+def get_state(agent_id, observations):
     '''
-    A cleaner way of getting the state for a user. Assumes that information setting is black-box.
+    A cleaner way of getting the state for a user from the observations returned by the market,
+    instead of computing it again. Assumes that information setting is black-box.
     '''
-    return market.setting.get_state(agent_id, market.deal_history, market.agents, market.offers)[0]
+    return observations[agent_id][0]
     
 def policy(S_t, Q):
     return np.argmax(Q[S_t])*10
@@ -69,8 +75,12 @@ for i in range(num_sellers, num_sellers + num_buyers):
 market = MarketEnvironment(sellers=agent_list[0:num_sellers], buyers=agent_list[num_sellers:num_sellers+num_buyers], max_steps=10,  
     matcher=matchers.RandomMatcher(reward_on_reference=True), setting=info_settings.BlackBoxSetting)
 
+# RLFM_PROFILE=start:stop profiles the episodes start to stop - 1, see profiling.py
+profiler = EpisodeProfiler.from_env()
 
 for i in range (0, num_episodes):
+    if profiler is not None:
+        profiler.episode(i)
     init_observation = market.reset()
     
     # resetting the agents
@@ -101,7 +111,7 @@ for i in range (0, num_episodes):
         offers = {}
 
         for a_id, a in agent_dict.items():
-            state = get_state(a_id, market)
+            state = get_state(a_id, observations)
 
             if (a_id == rl_agent):
                 new_offer = a.b_policy(a.behavior_buyer, state) # call your RL algorithm here
@@ -128,6 +138,8 @@ for i in range (0, num_episodes):
                 
 
     
+if profiler is not None:
+    profiler.close()
 
 total_rewards = {}
 for a_id, a in agent_dict.items():
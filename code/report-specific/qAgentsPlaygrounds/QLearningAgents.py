@@ -140,4 +140,112 @@ class QLearningSeller(Seller):
             #self.done = True
             if verbose: print(f'Agent done!')
                 
-        self.state = self.next_state
\ No newline at end of file
+        self.state = self.next_state
+
+class QLearningPopulation:
+    def __init__(self, agents: list, rng=None):
+        """
+        A population of q-learning agents, which selects offers and updates the q tables of all
+        agents with a handful of array operations.
+        The q tables are stored in one array of shape (n_agents, n_states, n_states) and the
+        q_table attribute of every agent becomes a view of its slice, so the agent objects can
+        still be plotted and pickled. The state, next_state and done attributes of the agents are
+        written back by sync.
+        :param agents: a list of QLearningBuyer and QLearningSeller agents, with equal n_states
+        :param rng: the random generator used for exploration and tie-breaking, either a
+        numpy Generator or RandomState. Defaults to the global numpy random state.
+        """
+        n_states = set(agent.n_states for agent in agents)
+        assert len(n_states) == 1, "All agents of a population must have the same n_states!"
+        self.agents = agents
+        self.agent_ids = [agent.agent_id for agent in agents]
+        self.n_states = n_states.pop()
+        self.rng = np.random if rng is None else rng
+        self.q_tables = np.stack([agent.q_table for agent in agents]).astype(np.float64)
+        for i, agent in enumerate(agents):
+            agent.q_table = self.q_tables[i]
+        self.offers = np.stack([agent.offers for agent in agents])
+        self.state = np.array([agent.state for agent in agents], dtype=np.intp)
+        self.next_state = np.array([agent.next_state for agent in agents], dtype=np.intp)
+        self.alpha = np.array([agent.alpha for agent in agents], dtype=np.float64)
+        self.gamma = np.array([agent.gamma for agent in agents], dtype=np.float64)
+        self.epsilon = np.array([agent.epsilon for agent in agents], dtype=np.float64)
+        self.done = np.array([agent.done for agent in agents], dtype=bool)
+        self._index = np.arange(len(agents))
+
+    def reset(self):
+        """
+        Marks all agents as not done, at the start of a market episode.
+        """
+        self.done[:] = False
+
+    def get_offers(self, offers: dict, greedy=False):
+        """
+        Epsilon-greedy selection of the next offer for all agents, ties between maximal q values
+        are broken uniformly at random.
+        :param offers: the dictionary of offers of this step, updated with the agents' offers
+        :param greedy: if true always exploit, never explore
+        """
+        offers.update(zip(self.agent_ids, self.select_offers(greedy).tolist()))
+
+    def select_offers(self, greedy=False):
+        """
+        The array version of get_offers.
+        :param greedy: if true always exploit, never explore
+        :return: the next offer of every agent, in the order of the population
+        """
+        n_agents = self._index.shape[0]
+        explore = self.rng.random(n_agents) < (0 if greedy else self.epsilon)
+        random_states = (self.rng.random(n_agents) * self.n_states).astype(np.intp)
+        rows = self.q_tables[self._index, self.state]
+        ties = np.where(rows == rows.max(axis=1, keepdims=True),
+                        self.rng.random(rows.shape), -1.)
+        self.next_state = np.where(explore, random_states, ties.argmax(axis=1))
+        return self.offers[self._index, self.next_state]
+
+    def update_tables(self, done_dict: dict, rewards_dict: dict, negative_reward=0):
+        """
+        Updates the q tables of all agents, with the same rules as utils.update_q_tables:
+        until an agent has a deal it gets negative_reward, in the step of the deal it gets the
+        reward of the market, and after the deal its q table does not change.
+        :param done_dict: the dictionary of done flags returned by the market step
+        :param rewards_dict: the dictionary of rewards returned by the market step
+        :param negative_reward: the reward of the steps without a deal
+        """
+        market_done = np.fromiter((done_dict[agent_id] for agent_id in self.agent_ids),
+                                  dtype=bool, count=self._index.shape[0])
+        rewards = np.fromiter((rewards_dict[agent_id] for agent_id in self.agent_ids),
+                              dtype=np.float64, count=self._index.shape[0])
+        self.update_tables_arrays(market_done, rewards, negative_reward)
+
+    def update_tables_arrays(self, market_done: np.ndarray, rewards: np.ndarray, negative_reward=0):
+        """
+        The array version of update_tables.
+        :param market_done: the done flags of the market step, in the order of the population
+        :param rewards: the rewards of the market step, in the order of the population
+        :param negative_reward: the reward of the steps without a deal
+        """
+        reward = np.where(market_done, rewards, negative_reward)
+
+        learning = ~self.done
+        index, state, next_state = (self._index[learning], self.state[learning],
+                                    self.next_state[learning])
+        old_value = self.q_tables[index, state, next_state]
+        next_max = self.q_tables[index, next_state].max(axis=1)
+        alpha = self.alpha[learning]
+        self.q_tables[index, state, next_state] = \
+            (1 - alpha) * old_value + alpha * (reward[learning] + self.gamma[learning] * next_max)
+
+        # agents that were already done keep their state, as they are not updated anymore
+        self.state[learning] = next_state
+        self.done |= market_done
+
+    def sync(self):
+        """
+        Writes the state, next_state and done attributes back to the agent objects.
+        """
+        for i, agent in enumerate(self.agents):
+            agent.q_table = self.q_tables[i]
+            agent.state = int(self.state[i])
+            agent.next_state = int(self.next_state[i])
+            agent.done = bool(self.done[i])
@@ -0,0 +1,209 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import info_settings
+from agents import Buyer, Seller
+from environments import MarketEnvironment
+from matchers import RandomMatcher
+
+SIZES = [2, 10, 100, 1000, 10000]
+SETTINGS = ['BlackBoxSetting', 'SameSideSetting', 'OtherSideSetting', 'FullInformationSetting',
+            'DealInformationSetting', 'DealFullInformationSetting', 'OfferHistorySetting']
+# engine name -> MarketEnvironment keyword arguments
+ENGINES = {
+    'pandas': dict(engine='pandas'),
+    'array': dict(engine='array'),
+    'array+book': dict(engine='array', order_book=True),
+}
+PERCENTILES = [50, 90, 99]
+# get_states of settings with per-agent vectors allocates n_agents x n_agents values
+MAX_OBS_VALUES = 2 * 10 ** 7
+
+
+def time_call(fn, setup=None, warmup=5, repeat=50):
+    '''
+    Times fn over repeat calls after warmup untimed calls.
+    setup is called untimed before every call and its result is passed to fn.
+    Returns the timing statistics in microseconds.
+    '''
+    samples = np.empty(repeat)
+    for i in range(warmup + repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter_ns()
+        fn(arg)
+        elapsed = time.perf_counter_ns() - start
+        if i >= warmup:
+            samples[i - warmup] = elapsed / 1000
+    stats = dict(repeat=repeat, mean_us=samples.mean(), std_us=samples.std(),
+                 min_us=samples.min(), max_us=samples.max())
+    for q, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+        stats[f'p{q}_us'] = value
+    return dict((key, float(value)) for key, value in stats.items())
+
+
+def make_agents(n_agents, sellr_reserve=20, buyer_reserve=100):
+    '''
+    Returns n_agents // 2 sellers and the remaining agents as buyers.
+    '''
+    n_sellers = n_agents // 2
+    sellers = [Seller(f'S{i}', sellr_reserve) for i in range(n_sellers)]
+    buyers = [Buyer(f'B{i}', buyer_reserve) for i in range(n_agents - n_sellers)]
+    return sellers, buyers
+
+
+def random_offers(rs, agent_ids, grid=np.linspace(20, 100, 11)):
+    '''
+    One offer from the grid of the playground agents for every agent.
+    '''
+    return dict(zip(agent_ids, rs.choice(grid, size=len(agent_ids)).tolist()))
+
+
+def bench_env(n_agents, engine, setting, rs, warmup, repeat):
+    sellers, buyers = make_agents(n_agents)
+    market_env = MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=30,
+                                   matcher=RandomMatcher(reward_on_reference=True),
+                                   setting=getattr(info_settings, setting), **ENGINES[engine])
+    agent_ids = market_env.agent_id_list
+    results = [dict(benchmark='env.reset',
+                    **time_call(lambda _: market_env.reset(), warmup=warmup, repeat=repeat)),
+               dict(benchmark='env.reset_arrays',
+                    **time_call(lambda _: market_env.reset_arrays(), warmup=warmup,
+                                repeat=repeat))]
+
+    def setup():
+        if market_env.terminated or market_env.truncated:
+            market_env.reset()
+        return random_offers(rs, agent_ids)
+
+    results.append(dict(benchmark='env.step', **time_call(market_env.step, setup, warmup, repeat)))
+    return results
+
+
+def bench_matcher(n_agents, rs, warmup, repeat):
+    sellers, buyers = make_agents(n_agents)
+    market_env = MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=30,
+                                   matcher=RandomMatcher(reward_on_reference=True),
+                                   setting=info_settings.BlackBoxSetting)
+    matcher = market_env.matcher
+    agents = market_env.agents
+    agent_ids = market_env.agent_id_list
+    is_buyer = market_env.is_buyer
+    res_prices = market_env.res_prices
+
+    def setup_frame():
+        return dict(current_actions=random_offers(rs, agent_ids), offers=market_env.offers.copy(),
+                    env_time=1, agents=agents, matched=set(),
+                    done=dict.fromkeys(agent_ids, False), deal_history=[])
+
+    def setup_arrays():
+        offers = random_offers(rs, agent_ids)
+        return dict(action_idx=np.arange(n_agents), action_values=np.array(list(offers.values())),
+                    offers=np.zeros(n_agents), times=np.zeros(n_agents, dtype=np.int64),
+                    is_buyer=is_buyer, res_prices=res_prices,
+                    matched=np.zeros(n_agents, dtype=bool), env_time=1)
+
+    return [dict(benchmark='matcher.match',
+                 **time_call(lambda kwargs: matcher.match(**kwargs), setup_frame, warmup, repeat)),
+            dict(benchmark='matcher.match_arrays',
+                 **time_call(lambda kwargs: matcher.match_arrays(**kwargs), setup_arrays, warmup,
+                             repeat))]
+
+
+def bench_setting(n_agents, setting, rs, warmup, repeat):
+    sellers, buyers = make_agents(n_agents)
+    market_env = MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=30,
+                                   matcher=RandomMatcher(reward_on_reference=True),
+                                   setting=info_settings.BlackBoxSetting)
+    market_env.step(random_offers(rs, market_env.agent_id_list))
+    info_setting = getattr(info_settings, setting)(market_env.agents)
+    agents = market_env.agents
+    offers = market_env.offers
+    offer_values = offers['offer'].to_numpy(dtype=np.float64)
+    deal_history = market_env.deal_history
+    agent_ids = market_env.agent_id_list
+
+    results = [dict(benchmark='setting.get_state',
+                    **time_call(lambda agent_id: info_setting.get_state(agent_id, deal_history,
+                                                                        agents, offers),
+                                lambda: agent_ids[rs.randint(n_agents)], warmup, repeat))]
+    obs_dim = info_setting.observation_space.shape[0]
+    if n_agents * obs_dim <= MAX_OBS_VALUES:
+        results.append(dict(benchmark='setting.get_states',
+                            **time_call(lambda _: info_setting.get_states(deal_history,
+                                                                          offer_values),
+                                        warmup=warmup, repeat=repeat)))
+    if info_setting.records_offers:
+        info_setting.start_round(market_env.max_steps)
+        results.append(dict(benchmark='setting.record_offers',
+                            **time_call(lambda _: info_setting.record_offers(1, offer_values),
+                                        warmup=warmup, repeat=repeat)))
+    if info_setting.get_shared_states(deal_history, offer_values) is not None:
+        results.append(dict(benchmark='setting.get_shared_states',
+                            **time_call(lambda _: info_setting.get_shared_states(deal_history,
+                                                                                 offer_values),
+                                        warmup=warmup, repeat=repeat)))
+    return results
+
+
+def run(sizes=SIZES, engines=ENGINES, settings=SETTINGS, warmup=5, repeat=50, seed=0,
+        groups=('env', 'matcher', 'setting')):
+    '''
+    Runs the micro-benchmarks and returns them as a dictionary with the keys 'meta' and 'results'.
+    The environment is benchmarked with the BlackBoxSetting, so that the step cost is not
+    dominated by observations; the settings are benchmarked on their own.
+    '''
+    rs = np.random.RandomState(seed)
+    random.seed(seed)
+    results = []
+    for n_agents in sizes:
+        if 'env' in groups:
+            for engine in engines:
+                for result in bench_env(n_agents, engine, 'BlackBoxSetting', rs, warmup, repeat):
+                    results.append(dict(n_agents=n_agents, engine=engine, **result))
+        if 'matcher' in groups:
+            for result in bench_matcher(n_agents, rs, warmup, repeat):
+                results.append(dict(n_agents=n_agents, **result))
+        if 'setting' in groups:
+            for setting in settings:
+                for result in bench_setting(n_agents, setting, rs, warmup, repeat):
+                    results.append(dict(n_agents=n_agents, setting=setting, **result))
+    meta = dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), python=sys.version.split()[0],
+                numpy=np.__version__, pandas=pd.__version__, platform=platform.platform(),
+                processor=platform.processor(), sizes=list(sizes), warmup=warmup, repeat=repeat,
+                seed=seed)
+    return dict(meta=meta, results=results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the market environment, '
+                                                 'the matcher and the information settings.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--settings', nargs='+', default=SETTINGS, choices=SETTINGS)
+    parser.add_argument('--groups', nargs='+', default=['env', 'matcher', 'setting'],
+                        choices=['env', 'matcher', 'setting'])
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='micro_benchmarks.json')
+    args = parser.parse_args(argv)
+
+    report = run(args.sizes, args.engines, args.settings, args.warmup, args.repeat, args.seed,
+                 args.groups)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for result in report['results']:
+        label = result.get('engine', result.get('setting', ''))
+        print(f"{result['benchmark']:<27}{label:<28}n={result['n_agents']:<7}"
+              f"p50={result['p50_us']:>12.1f}us  p90={result['p90_us']:>12.1f}us")
+
+
+if __name__ == '__main__':
+    main()
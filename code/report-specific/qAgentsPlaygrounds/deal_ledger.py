@@ -0,0 +1,174 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+# the source of the ledger epochs, see DealLedger.epoch
+_EPOCHS = itertools.count()
+
+
+class DealLedger:
+    def __init__(self, agent_ids: list, capacity: int):
+        """
+        The deals of a market round, stored column-wise in preallocated arrays: the seller
+        position, the buyer position, the time step and the deal price of every deal, in the order
+        of the deals. Deals are appended at a cursor, clear moves the cursor back to the start.
+        The ledger can be used like the list of deal dictionaries it replaces: indexing and
+        iteration give dictionaries with the keys Seller, Buyer, time and deal_price.
+        :param agent_ids: the agent ids in the order of the agent positions
+        :param capacity: the number of deals to preallocate, e.g. the maximum number of deals of
+        a round. The arrays grow when more deals are appended.
+        The epoch identifies the sequence of deals held by the ledger: a new ledger, clear and copy
+        take a new epoch, appending deals keeps it. A reader that has seen the first k deals of
+        an epoch only has to read the deals after k.
+        """
+        self.agent_ids = np.asarray(agent_ids, dtype=object)
+        self.index = dict((agent_id, i) for i, agent_id in enumerate(agent_ids))
+        capacity = max(1, capacity)
+        self._sellers = np.zeros(capacity, dtype=np.intp)
+        self._buyers = np.zeros(capacity, dtype=np.intp)
+        self._times = np.zeros(capacity, dtype=np.int64)
+        self._prices = np.zeros(capacity, dtype=np.float64)
+        self.size = 0
+        self.epoch = next(_EPOCHS)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(self.size))]
+        if item < 0:
+            item += self.size
+        if not 0 <= item < self.size:
+            raise IndexError('deal index out of range')
+        return dict(Seller=self.agent_ids[self._sellers[item]],
+                    Buyer=self.agent_ids[self._buyers[item]],
+                    time=int(self._times[item]), deal_price=float(self._prices[item]))
+
+    def __iter__(self):
+        return (self[i] for i in range(self.size))
+
+    def __eq__(self, other):
+        if isinstance(other, (DealLedger, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f'DealLedger({list(self)})'
+
+    @property
+    def sellers(self):
+        """
+        The seller positions of the deals, a read-only view valid until the ledger changes.
+        """
+        return self._view(self._sellers)
+
+    @property
+    def buyers(self):
+        """
+        The buyer positions of the deals, a read-only view valid until the ledger changes.
+        """
+        return self._view(self._buyers)
+
+    @property
+    def times(self):
+        """
+        The time steps of the deals, a read-only view valid until the ledger changes.
+        """
+        return self._view(self._times)
+
+    @property
+    def prices(self):
+        """
+        The deal prices, a read-only view valid until the ledger changes.
+        """
+        return self._view(self._prices)
+
+    def record(self, sellers: np.ndarray, buyers: np.ndarray, time: int, prices: np.ndarray):
+        """
+        Appends the deals of one market step.
+        :param sellers: the seller position per deal
+        :param buyers: the buyer position per deal
+        :param time: the time step of the deals
+        :param prices: the deal price per deal
+        """
+        n_deals = len(prices)
+        if n_deals == 0:
+            return
+        start, stop = self.size, self.size + n_deals
+        self._reserve(stop)
+        self._sellers[start:stop] = sellers
+        self._buyers[start:stop] = buyers
+        self._times[start:stop] = time
+        self._prices[start:stop] = prices
+        self.size = stop
+
+    def append(self, deal: dict):
+        """
+        Appends one deal given as a dictionary with the keys Seller, Buyer, time and deal_price,
+        as the matchers append to a deal history list.
+        """
+        self._reserve(self.size + 1)
+        self._sellers[self.size] = self.index[deal['Seller']]
+        self._buyers[self.size] = self.index[deal['Buyer']]
+        self._times[self.size] = deal['time']
+        self._prices[self.size] = deal['deal_price']
+        self.size += 1
+
+    def clear(self):
+        """
+        Removes all deals, without releasing the arrays.
+        """
+        self.size = 0
+        self.epoch = next(_EPOCHS)
+
+    def copy(self):
+        """
+        :return: a new ledger with the deals of this one
+        """
+        ledger = DealLedger.__new__(DealLedger)
+        ledger.agent_ids = self.agent_ids
+        ledger.index = self.index
+        ledger._sellers = self._sellers[:max(1, self.size)].copy()
+        ledger._buyers = self._buyers[:max(1, self.size)].copy()
+        ledger._times = self._times[:max(1, self.size)].copy()
+        ledger._prices = self._prices[:max(1, self.size)].copy()
+        ledger.size = self.size
+        ledger.epoch = next(_EPOCHS)
+        return ledger
+
+    def to_frame(self, copy=True):
+        """
+        Builds a DataFrame of the deals from the arrays, with the columns Seller, Buyer, time and
+        deal_price, equal to pd.DataFrame of the list of deal dictionaries.
+        :param copy: if false the time and deal_price columns are read-only views of the ledger
+        arrays, which are only valid until the ledger is cleared. They are views because the two
+        columns have different dtypes, so pandas keeps each in a block of its own
+        :return: a new DataFrame with one row per deal
+        """
+        times, prices = self.times, self.prices
+        frame = pd.DataFrame(dict(Seller=self.agent_ids[self.sellers],
+                                  Buyer=self.agent_ids[self.buyers],
+                                  time=times, deal_price=prices),
+                             columns=['Seller', 'Buyer', 'time', 'deal_price'], copy=copy)
+        if not copy and self.size and not (np.shares_memory(frame['time'].values, times)
+                                           and np.shares_memory(frame['deal_price'].values, prices)):
+            raise ValueError("This pandas version copies the ledger arrays, use copy=True")
+        return frame
+
+    def _view(self, array):
+        view = array[:self.size]
+        view.flags.writeable = False
+        return view
+
+    def _reserve(self, size):
+        capacity = self._prices.shape[0]
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name in ('_sellers', '_buyers', '_times', '_prices'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:array.shape[0]] = array
+            setattr(self, name, grown)
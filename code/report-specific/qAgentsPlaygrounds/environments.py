@@ -6,17 +6,53 @@ __maintainer__ = "Thomas Asikis"
 
 from gym import Env
 from abc import abstractmethod
+import numpy as np
 import pandas as pd
+from deal_ledger import DealLedger
+from info_settings import LazyStates
+from order_book import OrderBook
+from registry import AgentRegistry
+
+ENGINES = ('pandas', 'array')
+STATE_MODES = ('eager', 'lazy', 'none')
 
 
 class MarketEnvironment(Env):
-    def __init__(self, sellers: list, buyers: list, max_steps: int, matcher, setting):
+    def __init__(self, sellers: list, buyers: list, max_steps: int, matcher, setting,
+                 engine: str = 'pandas', order_book: bool = False, state_mode: str = 'eager',
+                 tape=None, recorder=None, timer=None):
         """
         An abstract market environment extending the typical gym environment
         :param sellers: A list containing all the agents that are extending the Seller agent
         :param buyers: A list containing all the agents that are extending the Buyer agent
-        :param max_steps: the maximum number of steps that runs for this round.
+        :param max_steps: the maximum number of steps that runs for this round, after which the
+        round is reported as truncated.
+        :param engine: 'pandas' keeps the offers in a DataFrame, 'array' keeps them in NumPy
+        arrays indexed by agent position (sellers first, then buyers). Both engines return
+        identical results; the 'array' engine requires a matcher with supports_arrays.
+        :param order_book: only for the 'array' engine, keep the unmatched offers in a persistent
+        OrderBook that is updated with the submitted offers, instead of sorting them on every
+        step. Requires a matcher with supports_book.
+        :param state_mode: how reset and step return the states. 'eager' computes the states of
+        all agents, 'lazy' returns a LazyStates mapping, which computes the state of an agent on
+        first access, and 'none' returns None instead of the states, for callers that do not use
+        them.
+        :param tape: an optional OfferTape, which records the offers and the matched flags of all
+        agents after every step. A reset starts a new episode of the tape.
+        :param recorder: an optional MarketRecorder, which records the actions, the matcher draws
+        and the outputs of every step, for a deterministic replay against another engine.
+        :param timer: an optional PhaseTimer, which times the phases 'match' and 'get_state' of
+        every step. It can also be set later as the timer attribute.
         """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {ENGINES}")
+        if state_mode not in STATE_MODES:
+            raise ValueError(f"Unknown state mode '{state_mode}', expected one of {STATE_MODES}")
+        self.engine = engine
+        self.state_mode = state_mode
+        self.tape = tape
+        self.recorder = recorder
+        self.timer = timer
         self.sellers = [dict(id=x.agent_id, res_price=x.reservation_price, role="Seller") for x in
                         sellers]
         self.buyers = [dict(id=x.agent_id, res_price=x.reservation_price, role="Buyer")
@@ -29,18 +65,107 @@ class MarketEnvironment(Env):
         # assign matcher and assign info setting
         self.matcher = matcher
         self.setting = setting(self.agents)
+        # settings with a history, e.g. OfferHistorySetting, are told about rounds and steps
+        self.records_offers = self.setting.records_offers
+        if engine == 'array' and not matcher.supports_arrays:
+            raise ValueError(f"{type(matcher).__name__} does not support the array engine")
+        if order_book and (engine != 'array' or not matcher.supports_book):
+            raise ValueError("The order book requires the array engine and a matcher "
+                             "implementing match_book")
 
         self.n_sellers = len(self.sellers)
         self.n_buyers = len(self.buyers)
-        self.matched: set = None
-        self.deal_history: list = None
-        self.offers = None
+
+        # structure-of-arrays view of the agents, the row order is the one of self.agents
+        self.registry = AgentRegistry(self.agents['id'].tolist())
+        self.agent_id_list = self.registry.ids
+        self.agent_index = self.registry.index
+        self.is_buyer = (self.agents['role'] == 'Buyer').to_numpy()
+        self.res_prices = self.agents['res_price'].to_numpy(dtype=np.float64)
+        self.offer_values: np.ndarray = None
+        self.offer_times: np.ndarray = None
+        self.matched_mask: np.ndarray = None
+        self.done_mask: np.ndarray = None
+        self.order_book = OrderBook(self.is_buyer) if order_book else None
+
+        self._matched: set = None
+        # the deals of the current round, cleared by reset
+        self.deal_history = DealLedger(self.agent_id_list, min(self.n_sellers, self.n_buyers))
+        self._offers = None
         self.current_actions = dict()
         self.realized_deals = None
         self.time = None
-        self.done = None
+        self._done: dict = None
+        self.terminated = None
+        self.truncated = None
+        self._init_template()
+        if recorder is not None:
+            recorder.attach(self)
         self.reset()
 
+    @property
+    def offers(self):
+        """
+        The offers DataFrame with columns id, res_price, role, offer and time.
+        With the 'array' engine the DataFrame is built from the arrays on every access, a snapshot
+        of the current offers. Its arrays are read-only, so that writing into it raises instead
+        of being lost; offer_values and offer_times hold the offers of the market, and
+        offers_frame or copy give a writable DataFrame.
+        """
+        if self.engine == 'array':
+            frame = self.offers_frame()
+            # the DataFrame has no public read-only flag, its blocks are made read-only
+            for block in frame._mgr.blocks:
+                block.values.flags.writeable = False
+            return frame
+        return self._offers
+
+    @offers.setter
+    def offers(self, value):
+        if self.engine == 'array':
+            raise AttributeError("The offers of the 'array' engine are read-only, set "
+                                 "offer_values and offer_times instead")
+        self._offers = value
+
+    @property
+    def matched(self):
+        """
+        The set of ids of the agents that have a deal in this round.
+        With the 'array' engine the set is built from matched_mask on the first access after a step.
+        """
+        if self._matched is None:
+            self._matched = set(np.asarray(self.agent_id_list, dtype=object)[self.matched_mask])
+        return self._matched
+
+    @matched.setter
+    def matched(self, value):
+        self._matched = value
+
+    @property
+    def done(self):
+        """
+        The done flag per agent id.
+        With the 'array' engine the dictionary is built from done_mask on the first access after a
+        step.
+        """
+        if self._done is None:
+            self._done = self.registry.to_dict(self.done_mask)
+        return self._done
+
+    @done.setter
+    def done(self, value):
+        self._done = value
+
+    def offers_frame(self):
+        """
+        Builds a DataFrame view of the array state, in the layout of the 'pandas' engine.
+        :return: a new DataFrame with one row per agent
+        """
+        frame = self.agents.copy()
+        frame['offer'] = self.offer_values
+        frame['time'] = self.offer_times
+        return frame
+
     def step(self, actions):
         """
         The step function takes the agents actions and returns the new state, reward,
@@ -49,7 +174,22 @@ class MarketEnvironment(Env):
         :return: a tuple of 4 objects: the object describing the next state, a data structure
         containing the reward per agent, a data structure containing boolean values expressing
         whether an agent reached a terminal state, and finally a dictionary object containing any extra info.
+        The info contains 'terminated', true when no deal is possible anymore because the highest
+        reservation price of the unmatched buyers is below the lowest reservation price of the
+        unmatched sellers (or one side has no unmatched agent left), and 'truncated', true when the
+        round is not terminated but has run for max_steps steps.
         """
+        if self.engine == 'array':
+            new_state, rewards, _, info = self._step_arrays(self.registry.scatter(actions),
+                                                            by_id=True)
+            return new_state, self.registry.to_dict(rewards), self.done, info
+        new_state, rewards, info = self._step_frame(actions, by_id=True)
+        return new_state, rewards, self.done, info
+
+    def _step_frame(self, actions, by_id):
+        timer = self.timer
+        if timer is not None:
+            start = timer.clock()
         rewards = self.matcher.match(
             current_actions=actions,
             offers=self.offers,
@@ -59,37 +199,220 @@ class MarketEnvironment(Env):
             done=self.done,
             deal_history=self.deal_history
         )
-        new_state = dict((agent_id, self.setting.get_state(agent_id, self.deal_history, self.agents,
-                                                           self.offers))
-                         for agent_id in self.agents['id'])
+        if timer is not None:
+            start = timer.lap('match', start)
+        if self.records_offers:
+            self.setting.record_offers(self.time + 1,
+                                       self.offers['offer'].to_numpy(dtype=np.float64))
+        new_state = self._get_states(by_id)
+        if timer is not None:
+            timer.lap('get_state', start)
+        unmatched = ~np.fromiter(self.done.values(), dtype=bool, count=len(self.done))
+        if self.tape is not None:
+            self.tape.record(self.time, self.offers['offer'].to_numpy(dtype=np.float64), ~unmatched)
         self.time += 1
-        return new_state, rewards, self.done, None
+        info = self._end_of_round(unmatched)
+        if self.recorder is not None:
+            self.recorder.record_step(actions, rewards, ~unmatched, info, new_state)
+        return new_state, rewards, info
+
+    def step_arrays(self, offers: np.ndarray):
+        """
+        The step function on agent positions instead of agent ids, see step.
+        :param offers: an array with the offer per agent position, NaN for agents that do not
+        submit an offer
+        :return: a tuple of 4 objects: the states as an array of shape (n_agents, obs_dim) (with
+        the 'lazy' state mode a LazyStates mapping keyed by position, with 'none' None), the
+        rewards as an array of shape (n_agents,), the done flags as a boolean array of shape
+        (n_agents,) and the info dictionary.
+        """
+        if self.engine != 'array':
+            # NaN is the only value that is not equal to itself
+            actions = dict((agent_id, offer) for agent_id, offer in
+                           zip(self.agent_id_list, np.asarray(offers).tolist()) if offer == offer)
+            new_state, rewards, info = self._step_frame(actions, by_id=False)
+            done = np.fromiter(self.done.values(), dtype=bool, count=len(self.done))
+            return new_state, self.registry.scatter(rewards, fill=0.), done, info
+        return self._step_arrays(offers, by_id=False)
+
+    def _step_arrays(self, offers, by_id):
+        timer = self.timer
+        if timer is not None:
+            start = timer.clock()
+        offers = np.asarray(offers, dtype=np.float64)
+        action_idx = np.flatnonzero(~np.isnan(offers))
+        action_values = offers[action_idx]
+        if self.order_book is not None:
+            rewards, deals = self.matcher.match_book(
+                book=self.order_book,
+                action_idx=action_idx,
+                action_values=action_values,
+                offers=self.offer_values,
+                times=self.offer_times,
+                res_prices=self.res_prices,
+                matched=self.matched_mask,
+                env_time=self.time
+            )
+        else:
+            rewards, deals = self.matcher.match_arrays(
+                action_idx=action_idx,
+                action_values=action_values,
+                offers=self.offer_values,
+                times=self.offer_times,
+                is_buyer=self.is_buyer,
+                res_prices=self.res_prices,
+                matched=self.matched_mask,
+                env_time=self.time
+            )
+        sellers, buyers, deal_prices = deals
+        self.deal_history.record(sellers, buyers, self.time, deal_prices)
+        if sellers.size:
+            self._matched = None
+            self._done = None
+        self.done_mask[:] = self.matched_mask
+        if timer is not None:
+            start = timer.lap('match', start)
+        if self.records_offers:
+            self.setting.record_offers(self.time + 1, self.offer_values)
+        new_state = self._get_states(by_id)
+        if timer is not None:
+            timer.lap('get_state', start)
+        if self.tape is not None:
+            self.tape.record(self.time, self.offer_values, self.matched_mask)
+        self.time += 1
+        info = self._end_of_round(~self.matched_mask)
+        if self.recorder is not None:
+            self.recorder.record_step(offers, rewards, self.done_mask, info, new_state)
+        return new_state, rewards, self.done_mask.copy(), info
+
+    def _end_of_round(self, unmatched: np.ndarray):
+        """
+        Updates the terminated and truncated flags of the round.
+        :param unmatched: boolean mask of the agents without a deal
+        :return: the info dictionary of a step
+        """
+        buyer_prices = self.res_prices[unmatched & self.is_buyer]
+        seller_prices = self.res_prices[unmatched & ~self.is_buyer]
+        self.terminated = bool(buyer_prices.size == 0 or seller_prices.size == 0 or
+                               buyer_prices.max() < seller_prices.min())
+        self.truncated = (not self.terminated and self.max_steps is not None and
+                          self.time >= self.max_steps)
+        return dict(terminated=self.terminated, truncated=self.truncated)
+
+    def _get_states(self, by_id):
+        """
+        :param by_id: key the states by agent id, otherwise by agent position
+        :return: the states of the agents in the state mode of the environment
+        """
+        if self.state_mode == 'none':
+            return None
+        if self.engine == 'array':
+            offers = self.offer_values
+        else:
+            offers = self.offers['offer'].to_numpy(dtype=np.float64)
+        if self.state_mode == 'lazy':
+            index = self.agent_index if by_id else range(len(self.agent_id_list))
+            return LazyStates(self.setting, index, self.deal_history, offers)
+        if by_id:
+            shared = self.setting.get_shared_states(self.deal_history, offers)
+            if shared is not None:
+                return self._shared_states_dict(shared)
+        states = self.setting.get_states(self.deal_history, offers)
+        return self.registry.to_dict(states) if by_id else states
+
+    def _shared_states_dict(self, shared):
+        """
+        :param shared: the result of get_shared_states of the setting
+        :return: the states keyed by agent id, the agents of a group get the same read-only view
+        of their shared state
+        """
+        states, groups = shared
+        views = list(states)
+        return self.registry.to_dict([views[group] for group in groups.tolist()])
 
     def reset(self):
         """
         Resets the environment to an initial state, so that the game can be repeated.
         :return: the initial state so that a new round begins.
         """
-        self.matched = set()
-        self.deal_history = list()
+        return self._reset(by_id=True)
+
+    def reset_arrays(self):
+        """
+        The reset function on agent positions instead of agent ids, see reset.
+        :return: the initial states as an array of shape (n_agents, obs_dim), in the state mode
+        of the environment
+        """
+        return self._reset(by_id=False)
+
+    def _reset(self, by_id):
+        self.deal_history.clear()
+        if self.tape is not None:
+            self.tape.new_episode()
+        if self.recorder is not None:
+            self.recorder.new_episode()
         self.time = 0
-        self.done = dict((x, False) for x in self.agents['id'].tolist())
-        self._init_offers()
+        if self.records_offers:
+            self.setting.start_round(self.max_steps)
+        if self.engine == 'array':
+            np.copyto(self.offer_values, self._initial_offers)
+            np.copyto(self.offer_times, self._initial_times)
+            np.copyto(self.matched_mask, self._initial_mask)
+            np.copyto(self.done_mask, self._initial_mask)
+            if self.order_book is not None:
+                self.order_book.restore(self._initial_book)
+            # built from the masks on first access
+            self.matched = None
+            self.done = None
+        else:
+            self.matched = set()
+            self.done = self._initial_done.copy()
+            self.offers = self._initial_frame.copy()
         self.realized_deals = []
         self.current_actions = dict()
-        new_state = dict((agent_id, self.setting.get_state(agent_id, self.deal_history, self.agents,
-                                                           self.offers))
-                         for agent_id in self.agents['id'])
-
-        return new_state
-
-    def _init_offers(self):
-        zero_actions = dict((agent_id, 0) for agent_id in self.agents['id'].unique())
-        self.offers = pd.merge(self.agents, pd.Series(zero_actions,
-                                                      name='offer').reset_index()
-                               .rename(columns={"index": "id"}), on='id')
-        self.offers['time'] = self.time
-        # display(self.offers)
+        self.terminated, self.truncated = self._initial_flags
+        if self.state_mode == 'eager':
+            if by_id and self._initial_shared is not None:
+                return self._shared_states_dict(self._initial_shared)
+            states = self._initial_states.copy()
+            return self.registry.to_dict(states) if by_id else states
+        return self._get_states(by_id)
+
+    def _init_template(self):
+        """
+        Precomputes the initial state of a round, which reset restores with in-place copies
+        instead of building it again. The template arrays are read-only.
+        """
+        n_agents = len(self.agent_id_list)
+        self.time = 0
+        self._initial_offers = np.zeros(n_agents, dtype=np.float64)
+        self._initial_times = np.zeros(n_agents, dtype=np.int64)
+        self._initial_mask = np.zeros(n_agents, dtype=bool)
+        for template in (self._initial_offers, self._initial_times, self._initial_mask):
+            template.flags.writeable = False
+        self._initial_shared = None
+        if self.state_mode == 'eager':
+            self._initial_states = self.setting.get_states([], self._initial_offers)
+            self._initial_states.flags.writeable = False
+            # read-only already, reset hands out views of the shared states
+            self._initial_shared = self.setting.get_shared_states([], self._initial_offers)
+        info = self._end_of_round(~self._initial_mask)
+        self._initial_flags = (info['terminated'], info['truncated'])
+        if self.engine == 'array':
+            self.offer_values = self._initial_offers.copy()
+            self.offer_times = self._initial_times.copy()
+            self.matched_mask = self._initial_mask.copy()
+            self.done_mask = self._initial_mask.copy()
+            if self.order_book is not None:
+                self.order_book.reset(self._initial_offers, self._initial_times)
+                self._initial_book = self.order_book.snapshot()
+            return
+        self._initial_done = dict((x, False) for x in self.agent_id_list)
+        zero_actions = dict((agent_id, 0) for agent_id in self.agent_id_list)
+        self._initial_frame = pd.merge(self.agents, pd.Series(zero_actions,
+                                                              name='offer').reset_index()
+                                       .rename(columns={"index": "id"}), on='id')
+        self._initial_frame['time'] = self.time
 
     @abstractmethod
     def render(self, mode='human'):
@@ -0,0 +1,221 @@
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import warnings
+
+import numpy as np
+
+import info_settings
+from agents import Buyer, Seller
+from environments import MarketEnvironment
+from matchers import RandomMatcher
+
+MISC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'misc')
+SETTINGS = ['BlackBoxSetting', 'SameSideSetting', 'OtherSideSetting', 'FullInformationSetting',
+            'DealInformationSetting', 'DealFullInformationSetting']
+# candidate name -> MarketEnvironment keyword arguments
+ENGINES = {
+    'pandas': dict(engine='pandas'),
+    'array': dict(engine='array'),
+    'array+book': dict(engine='array', order_book=True),
+    'array+lazy': dict(engine='array', state_mode='lazy'),
+}
+# the compared outputs of a step, in the order they are checked
+FIELDS = ('deals', 'rewards', 'done', 'states', 'offers')
+SELLER_RESERVES = [20, 40, 60]
+BUYER_RESERVES = [60, 80, 100]
+# few distinct offers, so that equal offers are common and the (offer, time) ordering decides
+OFFER_GRID = [20, 40, 50, 60, 80, 100]
+
+
+def load_reference():
+    '''
+    Imports the environments, matchers and info_settings modules of misc/, the reference pandas
+    implementation, under names that do not collide with the modules of this package.
+    Returns a dictionary of the three modules.
+    '''
+    modules = dict()
+    for name in ('environments', 'matchers', 'info_settings'):
+        spec = importlib.util.spec_from_file_location(f'reference_{name}',
+                                                      os.path.join(MISC_DIR, f'{name}.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        modules[name] = module
+    return modules
+
+
+def reference_factory():
+    '''
+    Returns a market factory, see candidate_factory, building the reference MarketEnvironment,
+    RandomMatcher and information settings of misc/.
+    '''
+    reference = load_reference()
+
+    def make_market(sellers, buyers, max_steps, reward_on_reference, setting):
+        matcher = reference['matchers'].RandomMatcher(reward_on_reference=reward_on_reference)
+        return reference['environments'].MarketEnvironment(
+            sellers, buyers, max_steps, matcher, getattr(reference['info_settings'], setting))
+    return make_market
+
+
+def candidate_factory(matcher_class=RandomMatcher, settings_module=info_settings, **env_kwargs):
+    '''
+    Returns a market factory for a candidate implementation: a function of the sellers, the
+    buyers, max_steps, reward_on_reference and the name of the setting, which builds a
+    MarketEnvironment with the given matcher class, the setting of settings_module and the
+    keyword arguments env_kwargs, e.g. engine='array'.
+    '''
+    def make_market(sellers, buyers, max_steps, reward_on_reference, setting):
+        return MarketEnvironment(sellers, buyers, max_steps,
+                                 matcher_class(reward_on_reference=reward_on_reference),
+                                 getattr(settings_module, setting), **env_kwargs)
+    return make_market
+
+
+def random_market(rs, max_agents=6):
+    '''
+    Draws the description of a randomized market: the seller and buyer counts and reservation
+    prices, the offer grid, the probability that an agent submits an offer in a step, and the
+    number of episodes and steps to play.
+    '''
+    n_sellers, n_buyers = rs.randint(1, max_agents + 1, size=2)
+    return dict(seller_reserves=rs.choice(SELLER_RESERVES, size=n_sellers).tolist(),
+                buyer_reserves=rs.choice(BUYER_RESERVES, size=n_buyers).tolist(),
+                grid=rs.choice(OFFER_GRID, size=rs.randint(2, len(OFFER_GRID) + 1),
+                               replace=False).tolist(),
+                submit=float(rs.choice([0.5, 0.8, 1.0])),
+                max_steps=int(rs.randint(5, 31)), episodes=int(rs.randint(1, 4)),
+                steps=int(rs.randint(1, 11)))
+
+
+def _observation(states, agent_ids):
+    # the reference returns float64 states, they are compared in the dtype of the observation
+    # spaces
+    return np.array([np.asarray(states[agent_id], dtype=np.float32).ravel()
+                     for agent_id in agent_ids])
+
+
+def trajectory(make_market, market, setting, reward_on_reference, seed):
+    '''
+    Plays a market built by make_market with random offers from the grid of the market
+    description. The offers are drawn from np.random.RandomState(seed) and the matcher draws from
+    the global random module seeded with seed, so the same seed gives the same offers and deal
+    price draws for every implementation.
+    Returns the list of steps, the reset of every episode included, each a dictionary of FIELDS.
+    '''
+    sellers = [Seller(f'S{i}', price) for i, price in enumerate(market['seller_reserves'])]
+    buyers = [Buyer(f'B{i}', price) for i, price in enumerate(market['buyer_reserves'])]
+    agent_ids = [agent.agent_id for agent in sellers + buyers]
+    rs = np.random.RandomState(seed)
+    random.seed(seed)
+    market_env = make_market(sellers, buyers, market['max_steps'], reward_on_reference, setting)
+    steps = []
+    for _ in range(market['episodes']):
+        states = market_env.reset()
+        steps.append(dict(states=_observation(states, agent_ids)))
+        for _ in range(market['steps']):
+            actions = dict((agent_id, float(rs.choice(market['grid']))) for agent_id in agent_ids
+                           if rs.rand() < market['submit'])
+            states, rewards, done, _ = market_env.step(actions)
+            deals = [(deal['Seller'], deal['Buyer'], deal['time'], deal['deal_price'])
+                     for deal in market_env.deal_history]
+            steps.append(dict(deals=deals, rewards=(list(rewards), list(rewards.values())),
+                              done=(list(done), list(done.values())),
+                              states=_observation(states, agent_ids),
+                              offers=market_env.offers[['offer', 'time']]
+                              .to_numpy(dtype=np.float64)))
+    return steps
+
+
+def _same(expected, actual):
+    if isinstance(expected, np.ndarray):
+        return (isinstance(actual, np.ndarray) and expected.shape == actual.shape and
+                np.array_equal(expected, actual, equal_nan=True))
+    return expected == actual
+
+
+def _difference(expected, actual):
+    for step, (expected_step, actual_step) in enumerate(zip(expected, actual)):
+        for field in FIELDS:
+            if field in expected_step and not _same(expected_step[field], actual_step.get(field)):
+                return dict(step=step, field=field, expected=expected_step[field],
+                            actual=actual_step.get(field))
+    return None
+
+
+def compare(reference, candidates: dict, n_markets=50, seed=0, settings=SETTINGS, max_agents=6):
+    '''
+    Plays n_markets randomized markets in every setting and both reward modes with the reference
+    and every candidate factory, under the same seeds, and compares the deals, rewards, done
+    flags, observations and offers of every step. The reference is played once per market.
+    candidates maps a name to a market factory.
+    Returns a dictionary with the first difference of every candidate, None if all its
+    trajectories are identical. A difference holds the market description, the setting, the
+    reward mode, the seed, the step (0 is the first reset) and the field, with the expected and
+    actual values.
+    '''
+    differences = dict.fromkeys(candidates)
+    rs = np.random.RandomState(seed)
+    for i in range(n_markets):
+        market = random_market(rs, max_agents)
+        market_seed = seed * n_markets + i
+        for setting in settings:
+            for reward_on_reference in (True, False):
+                args = (market, setting, reward_on_reference, market_seed)
+                expected = None
+                for name, candidate in candidates.items():
+                    if differences[name] is not None:
+                        continue
+                    if expected is None:
+                        expected = trajectory(reference, *args)
+                    difference = _difference(expected, trajectory(candidate, *args))
+                    if difference is not None:
+                        differences[name] = dict(market=market, setting=setting,
+                                                 reward_on_reference=reward_on_reference,
+                                                 seed=market_seed, **difference)
+                if all(difference is not None for difference in differences.values()):
+                    return differences
+    return differences
+
+
+def assert_equivalent(candidate, reference=None, **kwargs):
+    '''
+    Raises an AssertionError describing the first difference between the candidate factory and
+    the reference (default: the implementation of misc/), see compare for the keyword arguments.
+    '''
+    # the reference get_state implementations write into dataframe slices on purpose
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        difference = compare(reference_factory() if reference is None else reference,
+                             dict(candidate=candidate), **kwargs)['candidate']
+    assert difference is None, f'The candidate differs from the reference: {difference}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compares market engines with the reference '
+                                                 'implementation of misc/ on randomized markets.')
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--settings', nargs='+', default=SETTINGS, choices=SETTINGS)
+    parser.add_argument('--markets', type=int, default=50)
+    parser.add_argument('--max-agents', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    candidates = dict((engine, candidate_factory(**ENGINES[engine])) for engine in args.engines)
+    differences = compare(reference_factory(), candidates, args.markets, args.seed,
+                          args.settings, args.max_agents)
+    failed = False
+    for engine, difference in differences.items():
+        if difference is None:
+            print(f'{engine:<12}identical on {args.markets} markets')
+        else:
+            failed = True
+            print(f'{engine:<12}differs: {difference}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
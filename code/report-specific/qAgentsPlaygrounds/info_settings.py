@@ -5,13 +5,34 @@ __version__ = "0.1"
 __maintainer__ = "Thomas Asikis"
 
 
+from collections.abc import Mapping
 from gym.spaces import Box
 import numpy as np
 import pandas as pd
 from abc import abstractmethod
+from deal_ledger import DealLedger
+
+# the agents whose offers are observed by the OfferHistorySetting, relative to the observer's role
+HISTORY_SIDES = ('own', 'other', 'both')
+
+
+def deal_prices(deal_history):
+    """
+    :param deal_history: a DealLedger or a list of deal dictionaries
+    :return: the deal prices in the order of the deals
+    """
+    if isinstance(deal_history, DealLedger):
+        return deal_history.prices
+    return [deal['deal_price'] for deal in deal_history]
 
 
 class InformationSetting:
+    # the dtype of the states, the one of the observation spaces
+    dtype = np.float32
+    # settings that keep a state across the steps of a round set it, to get start_round and
+    # record_offers called by the environment
+    records_offers = False
+
     def __init__(self, agents):
         """
         An abstract implementation of an information setting.
@@ -19,11 +40,26 @@ class InformationSetting:
         describing of how a single agent observation looks like.
         Most of the time it will be a box environment, constraint between
         [low, high], with dimension defined by parameter shape.
+        The states are C-contiguous arrays of dtype self.dtype. get_states and get_state_at take
+        an optional out array to write them into, e.g. a slice of a batch of observations.
         :param agents:
         """
         self.agents = agents
         pass
 
+    def _out(self, shape: tuple, out: np.ndarray = None):
+        """
+        :param shape: the shape of the states
+        :param out: None or an array given to get_states or get_state_at
+        :return: out, or a new array of the shape and dtype of the states if out is None
+        """
+        if out is None:
+            return np.empty(shape, dtype=self.dtype)
+        if out.shape != shape or out.dtype != self.dtype:
+            raise ValueError(f"Expected an out array of shape {shape} and dtype "
+                             f"{np.dtype(self.dtype)}, got {out.shape} and {out.dtype}")
+        return out
+
     @abstractmethod
     def get_state(self, agent_id: str, deal_history: pd.DataFrame, agents: pd.DataFrame,
                   offers: pd.DataFrame):
@@ -37,6 +73,126 @@ class InformationSetting:
         """
         return np.zeros(1)
 
+    def get_states(self, deal_history: list, offers: np.ndarray, out: np.ndarray = None):
+        """
+        The method that generates the states of all agents at once, based on the information
+        setting. This default implementation calls get_state for every agent.
+        :param deal_history: the dictionary containing all the successful deals till now
+        :param offers: the last offer per agent, in the row order of the agents dataframe
+        :param out: an optional array of shape (number of agents, observation dimension) and
+        dtype self.dtype, into which the states are written
+        :return: an array of shape (number of agents, observation dimension), the row of an agent
+        is equal to its get_state result. It is out if given.
+        """
+        frame = self.agents.assign(offer=offers)
+        states = np.array([self.get_state(agent_id, deal_history, self.agents, frame)
+                           for agent_id in self.agents['id']], dtype=self.dtype)
+        if out is None:
+            return states
+        self._out(states.shape, out)[:] = states
+        return out
+
+    def get_state_at(self, position: int, deal_history: list, offers: np.ndarray,
+                     out: np.ndarray = None):
+        """
+        The method that generates the state of a single agent, given by its position.
+        This default implementation calls get_state.
+        :param position: the row of the agent in the agents dataframe
+        :param deal_history: the dictionary containing all the successful deals till now
+        :param offers: the last offer per agent, in the row order of the agents dataframe
+        :param out: an optional array of the shape of a state and dtype self.dtype, into which
+        the state is written
+        :return: the row of the agent in the result of get_states, out if given
+        """
+        frame = self.agents.assign(offer=offers)
+        state = np.array(self.get_state(self.agents['id'].iloc[position], deal_history,
+                                        self.agents, frame), dtype=self.dtype)
+        if out is None:
+            return state
+        self._out(state.shape, out)[:] = state
+        return out
+
+    def get_shared_states(self, deal_history: list, offers: np.ndarray):
+        """
+        The method that generates the states of all agents for settings in which groups of agents
+        observe the same vector, so that every group's vector is built once and shared.
+        This default implementation returns None, for settings without shared states.
+        :param deal_history: the dictionary containing all the successful deals till now
+        :param offers: the last offer per agent, in the row order of the agents dataframe
+        :return: None, or a tuple of a read-only array with one state per group and the group of
+        every agent, such that the state of the agent at a position is states[groups[position]]
+        """
+        return None
+
+    def arguments(self):
+        """
+        :return: the keyword arguments of the constructor besides the agents, with which the
+        setting is built again, e.g. by replay.make_market
+        """
+        return dict()
+
+    def start_round(self, max_steps: int):
+        """
+        Called by the environment when a round starts, for settings with records_offers.
+        :param max_steps: the maximum number of steps of the round, None if unbounded
+        """
+        pass
+
+    def record_offers(self, time: int, offers: np.ndarray):
+        """
+        Called by the environment once per step after the offers are matched and before the
+        states are generated, for settings with records_offers.
+        :param time: the number of steps played in the round, this one included
+        :param offers: the last offer per agent, in the row order of the agents dataframe
+        """
+        pass
+
+
+class LazyStates(Mapping):
+    def __init__(self, setting: InformationSetting, index, deal_history: list,
+                 offers: np.ndarray):
+        """
+        A read-only mapping to the states of the agents, which computes the state of an agent
+        with get_state_at on first access and caches it. For settings with shared states the
+        agents get read-only views of the shared states instead. It keeps its own copy of the offers and
+        the deals, so it holds the states of the step that created it.
+        :param setting: the information setting
+        :param index: a mapping from key to agent position, a dictionary of agent ids or
+        range(n_agents) to use the positions as keys
+        :param deal_history: the dictionary containing all the successful deals till now
+        :param offers: the last offer per agent, in the row order of the agents dataframe
+        """
+        self.setting = setting
+        self.index = index
+        self.deal_history = deal_history.copy()
+        self.offers = np.array(offers, dtype=np.float64)
+        self._states = dict()
+        # the shared states are built at once, they are only as large as one state per group
+        self._shared = setting.get_shared_states(self.deal_history, self.offers)
+        if self._shared is not None:
+            states, groups = self._shared
+            self._shared = list(states), groups
+
+    def __getitem__(self, key):
+        if self._shared is not None:
+            if key not in self.index:
+                raise KeyError(key)
+            views, groups = self._shared
+            return views[groups[self.index[key]]]
+        state = self._states.get(key)
+        if state is None:
+            if key not in self.index:
+                raise KeyError(key)
+            state = self.setting.get_state_at(self.index[key], self.deal_history, self.offers)
+            self._states[key] = state
+        return state
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
 
 class BlackBoxSetting(InformationSetting):
     def __init__(self, agents):
@@ -51,49 +207,93 @@ class BlackBoxSetting(InformationSetting):
     def get_state(self, agent_id: str, deal_history: pd.DataFrame, agents: pd.DataFrame,
                   offers: pd.DataFrame):
         last_offer = offers[offers['id'] == agent_id]['offer']
-        return np.array(last_offer)
+        return np.array(last_offer, dtype=self.dtype)
 
+    def get_states(self, deal_history: list, offers: np.ndarray, out: np.ndarray = None):
+        out = self._out((self.agents.shape[0], 1), out)
+        out[:, 0] = offers
+        return out
 
-class SameSideSetting(InformationSetting):
-    def __init__(self, agents):
+    def get_state_at(self, position: int, deal_history: list, offers: np.ndarray,
+                     out: np.ndarray = None):
+        out = self._out((1,), out)
+        out[0] = offers[position]
+        return out
+
+
+class RoleInformationSetting(InformationSetting):
+    def __init__(self, agents, observe_same_role: bool):
         """
-        The agent is only aware about the last offers submitted by agents sharing the same role.
-        The observation for each agent is a vector number of agents dimensions, which contains
-        positive
-        values for agents of the same role, and zero for agents of the other side.
+        The common implementation of the settings in which the agents observe the last offers of
+        one role: every seller observes the same vector and every buyer observes the same vector.
+        The role masks are computed once, and the two vectors of a step are shared by the agents
+        of their role as read-only views.
         :param agents: The dataframe of agents in the environment.
+        :param observe_same_role: the agents observe the offers of their own role, otherwise the
+        offers of the other role. The offers that are not observed are zero.
         """
         super().__init__(agents)
         self.observation_space = Box(low=0, high=np.infty, shape=[agents.shape[0]],
                                      dtype=np.float32)
+        is_buyer = (agents['role'] == 'Buyer').to_numpy()
+        self.roles = dict(zip(agents['id'], agents['role']))
+        self.observe_same_role = observe_same_role
+        # the role of every agent, 0 for sellers and 1 for buyers
+        self.role_index = is_buyer.astype(np.intp)
+        self.role_index.flags.writeable = False
+        # the offers observed by the sellers (row 0) and by the buyers (row 1)
+        self.observed = np.stack([~is_buyer, is_buyer]) == observe_same_role
 
     def get_state(self, agent_id: str, deal_history: pd.DataFrame, agents: pd.DataFrame,
                   offers: pd.DataFrame):
-        agent_role = agents.loc[agents['id'] == agent_id]['role'].iloc[0]
-        obs = offers[['role', 'offer']]
-        obs.loc[obs['role'] == agent_role, 'offer'] = 0
-        return obs['offer'].to_numpy()
+        same_role = (offers['role'] == self.roles[agent_id]).to_numpy()
+        offer = offers['offer'].to_numpy()
+        return np.where(same_role == self.observe_same_role, offer, 0).astype(self.dtype)
+
+    def get_shared_states(self, deal_history: list, offers: np.ndarray):
+        states = np.zeros(self.observed.shape, dtype=self.dtype)
+        np.copyto(states, offers, where=self.observed)
+        states.flags.writeable = False
+        return states, self.role_index
 
+    def get_states(self, deal_history: list, offers: np.ndarray, out: np.ndarray = None):
+        states, roles = self.get_shared_states(deal_history, offers)
+        return np.take(states, roles, axis=0, out=self._out((roles.shape[0],) * 2, out))
 
-class OtherSideSetting(InformationSetting):
+    def get_state_at(self, position: int, deal_history: list, offers: np.ndarray,
+                     out: np.ndarray = None):
+        out = self._out(self.role_index.shape, out)
+        out.fill(0)
+        np.copyto(out, offers, where=self.observed[self.role_index[position]])
+        return out
+
+
+class SameSideSetting(RoleInformationSetting):
+    def __init__(self, agents):
+        """
+        The agent is only aware about the last offers submitted by agents sharing the same role.
+        The observation for each agent is a vector number of agents dimensions, which contains
+        positive
+        values for agents of the same role, and zero for agents of the other side.
+        As in the reference implementation, the vector holds the offers of the other role and
+        zero for the agents of the same role.
+        :param agents: The dataframe of agents in the environment.
+        """
+        super().__init__(agents, observe_same_role=False)
+
+
+class OtherSideSetting(RoleInformationSetting):
     def __init__(self, agents):
         """
         The agent is only aware about the last offers submitted by agents sharing the other role.
         The observation for each agent is a vector number of agents dimensions, which contains
         positive
         values for agents of the other role, and zero for agents of the same side.
+        As in the reference implementation, the vector holds the offers of the same role and
+        zero for the agents of the other role.
         :param agents: The dataframe of agents in the environment.
         """
-        super().__init__(agents)
-        self.observation_space = Box(low=0, high=np.infty, shape=[agents.shape[0]],
-                                     dtype=np.float32)
-
-    def get_state(self, agent_id: str, deal_history: pd.DataFrame, agents: pd.DataFrame,
-                  offers: pd.DataFrame):
-        agent_role = agents.loc[agents['id'] == agent_id]['role'].iloc[0]
-        obs = offers[['role', 'offer']]
-        obs.loc[obs['role'] != agent_role, 'offer'] = 0
-        return obs['offer'].to_numpy()
+        super().__init__(agents, observe_same_role=True)
 
 
 class FullInformationSetting(InformationSetting):
@@ -112,7 +312,18 @@ class FullInformationSetting(InformationSetting):
     def get_state(self, agent_id: str, deal_history: pd.DataFrame, agents: pd.DataFrame,
                   offers: pd.DataFrame):
         obs = offers[['role', 'offer']]
-        return obs['offer'].to_numpy()
+        return obs['offer'].to_numpy(dtype=self.dtype)
+
+    def get_states(self, deal_history: list, offers: np.ndarray, out: np.ndarray = None):
+        out = self._out((self.agents.shape[0],) * 2, out)
+        out[:] = offers
+        return out
+
+    def get_state_at(self, position: int, deal_history: list, offers: np.ndarray,
+                     out: np.ndarray = None):
+        out = self._out((self.agents.shape[0],), out)
+        out[:] = offers
+        return out
 
 
 class DealInformationSetting(InformationSetting):
@@ -122,6 +333,9 @@ class DealInformationSetting(InformationSetting):
         The observation for each agent is a vector of dimensions equal to the minimum number
         of agents having the same role. The vector contains positive values for all successful
         offers and zeros otherwise.
+        Every agent observes the same vector, which is built once per step from a persistent
+        vector of the deal prices. With a DealLedger only the deals made since the previous
+        step are written into it.
         :param agents: The dataframe of agents in the environment.
         """
         super().__init__(agents)
@@ -130,14 +344,60 @@ class DealInformationSetting(InformationSetting):
         self.max_deal_n = min(seller_n, buyer_n)
         self.observation_space = Box(low=0, high=np.infty, shape=[self.max_deal_n],
                                      dtype=np.float32)
+        # every agent is in the single group of the shared state
+        self.groups = np.zeros(agents.shape[0], dtype=np.intp)
+        self.groups.flags.writeable = False
+        self._prices = np.zeros(self.max_deal_n, dtype=self.dtype)
+        # the epoch and the number of deals of the ledger that _prices holds
+        self._epoch = None
+        self._n_deals = 0
+
+    def deal_vector(self, deal_history):
+        """
+        Brings the persistent deal price vector up to date with the deal history. The deals of a
+        DealLedger that were written by the previous call of the same epoch are skipped, a list of
+        deals is written whole.
+        :param deal_history: a DealLedger, a list of deal dictionaries or None
+        :return: the deal prices padded with zeros to max_deal_n. The vector is overwritten by the
+        next call, callers that keep it have to copy it.
+        """
+        prices = self._prices
+        if isinstance(deal_history, DealLedger):
+            if deal_history.epoch != self._epoch:
+                prices.fill(0.)
+                self._epoch = deal_history.epoch
+                self._n_deals = 0
+            n_deals = len(deal_history)
+            prices[self._n_deals:n_deals] = deal_history.prices[self._n_deals:n_deals]
+            self._n_deals = n_deals
+            return prices
+        prices.fill(0.)
+        self._epoch = None
+        if deal_history:
+            new_prices = deal_prices(deal_history)
+            prices[:len(new_prices)] = new_prices
+        return prices
 
     def get_state(self, agent_id: str, deal_history: pd.DataFrame, agents: pd.DataFrame,
                   offers: pd.DataFrame):
-        res = np.zeros(self.max_deal_n)
-        if deal_history is not None:
-            for i in range(len(deal_history)):
-                res[i] = deal_history[i]['deal_price']
-        return res
+        return self.deal_vector(deal_history).copy()
+
+    def get_shared_states(self, deal_history: list, offers: np.ndarray):
+        states = self.deal_vector(deal_history)[np.newaxis].copy()
+        states.flags.writeable = False
+        return states, self.groups
+
+    def get_states(self, deal_history: list, offers: np.ndarray, out: np.ndarray = None):
+        # every agent observes the same deal prices
+        out = self._out((self.agents.shape[0], self.max_deal_n), out)
+        out[:] = self.deal_vector(deal_history)
+        return out
+
+    def get_state_at(self, position: int, deal_history: list, offers: np.ndarray,
+                     out: np.ndarray = None):
+        out = self._out((self.max_deal_n,), out)
+        out[:] = self.deal_vector(deal_history)
+        return out
 
 
 class DealFullInformationSetting(InformationSetting):
@@ -147,6 +407,8 @@ class DealFullInformationSetting(InformationSetting):
         The observation for each agent is a vector of dimensions equal to the minimum number
         of agents having the same role plus the number of agents.
         The vector contains positive values for all successful offers and zeros otherwise.
+        Every agent observes the same vector, the offers are written into it followed by the
+        deal prices of the deal setting, without intermediate arrays.
         :param agents: The dataframe of agents in the environment.
         """
         # the observation space for a single agent, is the size of all agents
@@ -154,13 +416,133 @@ class DealFullInformationSetting(InformationSetting):
         super().__init__(agents)
         self.deal_setting = DealInformationSetting(agents)
         self.full_info_setting = FullInformationSetting(agents)
-        self.n_feats = agents.shape[0] + self.deal_setting.max_deal_n
+        self.n_agents = agents.shape[0]
+        self.n_feats = self.n_agents + self.deal_setting.max_deal_n
         self.observation_space = Box(low=0, high=np.infty, shape=[self.n_feats], dtype=np.float32)
         # action space per agent should be the same
 
+    def _fill(self, out: np.ndarray, deal_history, offers):
+        out[:self.n_agents] = offers
+        out[self.n_agents:] = self.deal_setting.deal_vector(deal_history)
+        return out
+
     def get_state(self, agent_id: str, deal_history: pd.DataFrame, agents: pd.DataFrame,
                   offers: pd.DataFrame):
-        full_info_obs = self.full_info_setting.get_state(agent_id, deal_history, agents, offers)
-        deal_info_obs = self.deal_setting.get_state(agent_id, deal_history, agents, offers)
-        res = np.concatenate([full_info_obs, deal_info_obs])
-        return res
+        return self._fill(np.empty(self.n_feats, dtype=self.dtype), deal_history,
+                          offers['offer'].to_numpy())
+
+    def get_shared_states(self, deal_history: list, offers: np.ndarray):
+        states = np.empty((1, self.n_feats), dtype=self.dtype)
+        self._fill(states[0], deal_history, offers)
+        states.flags.writeable = False
+        return states, self.deal_setting.groups
+
+    def get_states(self, deal_history: list, offers: np.ndarray, out: np.ndarray = None):
+        # the first row is built, the others are copies of it
+        out = self._out((self.n_agents, self.n_feats), out)
+        self._fill(out[0], deal_history, offers)
+        out[1:] = out[0]
+        return out
+
+    def get_state_at(self, position: int, deal_history: list, offers: np.ndarray,
+                     out: np.ndarray = None):
+        return self._fill(self._out((self.n_feats,), out), deal_history, offers)
+
+
+class OfferHistorySetting(InformationSetting):
+    records_offers = True
+
+    def __init__(self, agents, k: int = 4, side: str = 'both'):
+        """
+        The agent is aware about the last k offers of the agents of its own role, of the other
+        role or of both, and about the time of the round.
+        The observation for each agent is the offer history, k vectors of number of agents
+        dimensions from the oldest to the latest step, in which the offers of the agents that are
+        not observed are zero, followed by the normalized time: the number of steps played divided
+        by max_steps, zero without max_steps. Steps before the start of the round are zero.
+        The history is a circular array written by the environment once per step with
+        record_offers, at a cost linear in the number of agents and independent of k. Every row
+        is written twice, at i and i + k, so that the last k steps are always a contiguous window.
+        A setting with other arguments is passed to the environment with functools.partial, e.g.
+        partial(OfferHistorySetting, k=8, side='other').
+        :param agents: The dataframe of agents in the environment.
+        :param k: the number of steps in the history
+        :param side: one of HISTORY_SIDES, whose offers the agents observe
+        """
+        super().__init__(agents)
+        if side not in HISTORY_SIDES:
+            raise ValueError(f"Unknown side '{side}', expected one of {HISTORY_SIDES}")
+        if k < 1:
+            raise ValueError(f'The history needs at least one step, got k={k}')
+        self.k = k
+        self.side = side
+        self.n_agents = agents.shape[0]
+        self.n_feats = k * self.n_agents + 1
+        self.observation_space = Box(low=0, high=np.infty, shape=[self.n_feats], dtype=np.float32)
+        self.positions = dict(zip(agents['id'], range(self.n_agents)))
+        is_buyer = (agents['role'] == 'Buyer').to_numpy()
+        if side == 'both':
+            # every agent observes the same vector
+            self.groups = np.zeros(self.n_agents, dtype=np.intp)
+            self.observed = np.ones((1, self.n_agents), dtype=bool)
+        else:
+            # as in RoleInformationSetting, row 0 is observed by the sellers, row 1 by the buyers
+            self.groups = is_buyer.astype(np.intp)
+            self.observed = np.stack([~is_buyer, is_buyer]) == (side == 'own')
+        self.groups.flags.writeable = False
+        self._buffer = np.zeros((2 * k, self.n_agents), dtype=self.dtype)
+        # the row of the next step, the window of the last k steps starts there
+        self._next = 0
+        self.max_steps = None
+        self.time = 0.
+
+    @property
+    def history(self):
+        """
+        :return: a view of the last k offers per agent, of shape (k, number of agents), from the
+        oldest to the latest step
+        """
+        return self._buffer[self._next:self._next + self.k]
+
+    def arguments(self):
+        return dict(k=self.k, side=self.side)
+
+    def start_round(self, max_steps: int):
+        self._buffer.fill(0)
+        self._next = 0
+        self.max_steps = max_steps
+        self.time = 0.
+
+    def record_offers(self, time: int, offers: np.ndarray):
+        row = self._next
+        self._buffer[row] = offers
+        self._buffer[row + self.k] = offers
+        self._next = (row + 1) % self.k
+        self.time = time / self.max_steps if self.max_steps else 0.
+
+    def _fill(self, out: np.ndarray, group: int):
+        np.multiply(self.history, self.observed[group],
+                    out=out[:-1].reshape(self.k, self.n_agents))
+        out[-1] = self.time
+        return out
+
+    def get_state(self, agent_id: str, deal_history: pd.DataFrame, agents: pd.DataFrame,
+                  offers: pd.DataFrame):
+        # the offers are the latest step of the history
+        return self._fill(np.empty(self.n_feats, dtype=self.dtype),
+                          self.groups[self.positions[agent_id]])
+
+    def get_shared_states(self, deal_history: list, offers: np.ndarray):
+        states = np.empty((self.observed.shape[0], self.n_feats), dtype=self.dtype)
+        for group, state in enumerate(states):
+            self._fill(state, group)
+        states.flags.writeable = False
+        return states, self.groups
+
+    def get_states(self, deal_history: list, offers: np.ndarray, out: np.ndarray = None):
+        states, groups = self.get_shared_states(deal_history, offers)
+        return np.take(states, groups, axis=0, out=self._out((self.n_agents, self.n_feats), out))
+
+    def get_state_at(self, position: int, deal_history: list, offers: np.ndarray,
+                     out: np.ndarray = None):
+        return self._fill(self._out((self.n_feats,), out), self.groups[position])
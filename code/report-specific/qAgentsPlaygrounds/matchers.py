@@ -5,15 +5,23 @@ __version__ = "0.1"
 __maintainer__ = "Thomas Asikis"
 
 import random
+import numpy as np
 import pandas as pd
 from abc import abstractmethod
 
 
 class Matcher:
+    # the matching methods a matcher implements besides match: match_arrays for the array engine
+    # (and match_batch of the vectorized markets) and match_book for the order book
+    supports_arrays = False
+    supports_book = False
+
     def __init__(self):
         """
         Abstract matcher object. This object is used by the Market environment to match agent offers
         and also decide the deal price.
+        A matcher that implements match_arrays or match_book sets supports_arrays or supports_book,
+        the environment checks these flags before it uses the array engine or the order book.
         """
         pass
 
@@ -41,9 +49,100 @@ class Matcher:
         rewards: dict = None
         return rewards
 
+    def match_arrays(self,
+                     action_idx: np.ndarray,
+                     action_values: np.ndarray,
+                     offers: np.ndarray,
+                     times: np.ndarray,
+                     is_buyer: np.ndarray,
+                     res_prices: np.ndarray,
+                     matched: np.ndarray,
+                     env_time: int):
+        """
+        The matching method used by the array engine of the market. All arrays are indexed by agent
+        position and the state arrays are updated in place.
+        :param action_idx: the agent positions that submitted an offer in this step
+        :param action_values: the submitted offers, aligned with action_idx
+        :param offers: the last offer per agent
+        :param times: the time step of the last offer per agent
+        :param is_buyer: boolean mask, true for buyers and false for sellers
+        :param res_prices: the reservation price per agent
+        :param matched: boolean mask of the agents matched in this round
+        :param env_time: the current time step in the market
+        :return: a tuple of the reward per agent as an array and the deals as a tuple of three
+        aligned arrays: seller positions, buyer positions and deal prices, in matching order
+        """
+        raise NotImplementedError
+
+    def match_batch(self,
+                    actions: np.ndarray,
+                    offers: np.ndarray,
+                    times: np.ndarray,
+                    is_buyer: np.ndarray,
+                    res_prices: np.ndarray,
+                    matched: np.ndarray,
+                    env_time: np.ndarray):
+        """
+        The matching method used by the vectorized market, which holds several independent
+        markets with the same agents as rows of 2-D arrays. The state arrays are updated in place.
+        Markets are matched in row order, which is the order of stepping one market after the
+        other. This default implementation calls match_arrays on every row.
+        :param actions: the offers submitted in this step per market and agent, NaN for no offer
+        :param offers: the last offer per market and agent
+        :param times: the time step of the last offer per market and agent
+        :param is_buyer: boolean mask over the agents, true for buyers and false for sellers
+        :param res_prices: the reservation price per agent
+        :param matched: boolean mask of the agents matched in this round, per market
+        :param env_time: the current time step per market
+        :return: a tuple of the reward per market and agent as an array and the deals as a tuple of
+        four aligned arrays: market rows, seller positions, buyer positions and deal prices
+        """
+        rewards = np.zeros(offers.shape)
+        deals = [], [], [], []
+        for row in range(offers.shape[0]):
+            action_idx = np.flatnonzero(~np.isnan(actions[row]))
+            rewards[row], row_deals = self.match_arrays(
+                action_idx=action_idx,
+                action_values=actions[row, action_idx],
+                offers=offers[row],
+                times=times[row],
+                is_buyer=is_buyer,
+                res_prices=res_prices,
+                matched=matched[row],
+                env_time=int(env_time[row])
+            )
+            deals[0].append(np.full(row_deals[0].shape[0], row))
+            for column, values in zip(deals[1:], row_deals):
+                column.append(values)
+        if offers.shape[0] == 0:
+            return rewards, (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                             np.zeros(0, dtype=np.intp), np.zeros(0))
+        return rewards, tuple(np.concatenate(column) for column in deals)
+
+    def match_book(self,
+                   book,
+                   action_idx: np.ndarray,
+                   action_values: np.ndarray,
+                   offers: np.ndarray,
+                   times: np.ndarray,
+                   res_prices: np.ndarray,
+                   matched: np.ndarray,
+                   env_time: int):
+        """
+        The matching method used by the array engine of the market when it keeps a persistent
+        order book. The matcher updates the book with the new offers and reads the pairs to match
+        off its top, instead of sorting the unmatched offers again.
+        :param book: the OrderBook of the market, holding the unmatched agents
+        Please check Matcher.match_arrays for the other parameters and the returned tuple.
+        """
+        raise NotImplementedError
+
 
 class RandomMatcher(Matcher):
-    def __init__(self, reward_on_reference=False):
+    supports_arrays = True
+    supports_book = True
+
+    def __init__(self, reward_on_reference=False, rng=None):
         """
         A random matcher, which decides the deal price of a matched pair by sampling a uniform
         distribution bounded in [seller_ask, buyer_bid] range.
@@ -54,9 +153,13 @@ class RandomMatcher(Matcher):
         and: reservation price - offer, for buyers.
         You may chose to use this reward scheme, but you have to justify why it is better than
         the old!
+        :param rng: the source of the uniform draws of the deal prices, an object with a random()
+        method like random.Random. None draws from the global random module. A MarketRecorder
+        replaces it to record the draws and replay to feed them back.
         """
         super().__init__()
         self.reward_on_reference = reward_on_reference
+        self.rng = rng
 
     def match(self,
               current_actions: dict,
@@ -78,50 +181,172 @@ class RandomMatcher(Matcher):
         :param deal_history: the dictionary containing all the successful deals till now
         :return: the dictionary containing the the agent id as keys and the rewards as values
         """
-        # update offers
-        for agent_id, offer in current_actions.items():
-            if agent_id not in matched:
-                offers.loc[offers['id'] == agent_id, ['offer', 'time']] = (offer, env_time)
+        # scatter the new offers into arrays, clear them and write the offers back
+        ids = offers['id']
+        positions = pd.Index(ids).get_indexer(list(current_actions.keys()))
+        known = positions >= 0
+        action_values = np.fromiter(current_actions.values(), dtype=np.float64,
+                                    count=len(current_actions))
+        offer_values = offers['offer'].to_numpy(dtype=np.float64)
+        times = offers['time'].to_numpy(dtype=np.int64)
+        rewards_array, (sellers, buyers, deal_prices) = self.match_arrays(
+            action_idx=positions[known],
+            action_values=action_values[known],
+            offers=offer_values,
+            times=times,
+            is_buyer=(offers['role'] == 'Buyer').to_numpy(),
+            res_prices=offers['res_price'].to_numpy(dtype=np.float64),
+            matched=ids.isin(matched).to_numpy(),
+            env_time=env_time
+        )
+        if known.any():
+            offers['offer'] = offer_values
+            offers['time'] = times
+
+        ids = ids.to_numpy()
+        rewards = dict((aid, 0) for aid in agents['id'].tolist())
+        for seller, buyer, deal_price in zip(sellers.tolist(), buyers.tolist(),
+                                             deal_prices.tolist()):
+            # keeping both done and matched is redundant
+            matched.add(ids[buyer])
+            matched.add(ids[seller])
+            done[ids[buyer]] = True
+            done[ids[seller]] = True
+            rewards[ids[buyer]] = rewards_array[buyer]
+            rewards[ids[seller]] = rewards_array[seller]
+            deal_history.append(dict(Seller=ids[seller], Buyer=ids[buyer], time=env_time,
+                                     deal_price=deal_price))
+
+        return rewards
+
+    def match_arrays(self,
+                     action_idx: np.ndarray,
+                     action_values: np.ndarray,
+                     offers: np.ndarray,
+                     times: np.ndarray,
+                     is_buyer: np.ndarray,
+                     res_prices: np.ndarray,
+                     matched: np.ndarray,
+                     env_time: int):
+        """
+        The clearing used by match and by the array engine of the market, which runs match_batch
+        on a single market. The ordering, the deal prices and the rewards are the same as in the
+        sequential matching loop.
+        Please check Matcher.match_arrays for the parameters.
+        """
+        actions = np.full((1, offers.shape[0]), np.nan)
+        actions[0, action_idx] = action_values
+        rewards, (_, sellers, buyers, deal_prices) = self.match_batch(
+            actions=actions,
+            offers=offers[np.newaxis],
+            times=times[np.newaxis],
+            is_buyer=is_buyer,
+            res_prices=res_prices,
+            matched=matched[np.newaxis],
+            env_time=np.array([env_time])
+        )
+        return rewards[0], (sellers, buyers, deal_prices)
+
+    def match_batch(self,
+                    actions: np.ndarray,
+                    offers: np.ndarray,
+                    times: np.ndarray,
+                    is_buyer: np.ndarray,
+                    res_prices: np.ndarray,
+                    matched: np.ndarray,
+                    env_time: np.ndarray):
+        """
+        The vectorized clearing of all markets in a few array passes.
+        Please check Matcher.match_batch for the parameters.
+        """
+        # update offers of the non-matched agents
+        live = ~np.isnan(actions) & ~matched
+        offers[live] = actions[live]
+        times[live] = np.broadcast_to(env_time[:, np.newaxis], times.shape)[live]
+
         # keep buyer and seller offers with non-matched ids sorted:
         # descending by offer value for buyers
         # ascending by offer value for sellers
-        # and do a second sorting on ascending time to break ties for both
-        buyer_offers = offers[(offers['role'] == 'Buyer') &
-                              (~offers['id'].isin(matched))] \
-            .sort_values(['offer', 'time'], ascending=[False, True])
+        # and do a second sorting on ascending time to break ties for both.
+        # np.lexsort is stable and sorts by the last key first, so ties in (offer, time) keep
+        # the agent order, as the pandas sort does. Matched agents go to the end of their book.
+        buyer_columns = np.flatnonzero(is_buyer)
+        seller_columns = np.flatnonzero(~is_buyer)
+        bid_keys = np.where(matched[:, buyer_columns], np.inf, -offers[:, buyer_columns])
+        buyers = buyer_columns[np.lexsort((times[:, buyer_columns], bid_keys), axis=-1)]
+        ask_keys = np.where(matched[:, seller_columns], np.inf, offers[:, seller_columns])
+        sellers = seller_columns[np.lexsort((times[:, seller_columns], ask_keys), axis=-1)]
 
-        seller_offers = offers[(offers['role'] == 'Seller') &
-                               (~offers['id'].isin(matched))] \
-            .sort_values(['offer', 'time'], ascending=[True, True])
+        # bids are non-increasing and asks non-decreasing, so the pairs that cross form a prefix
+        min_len = min(seller_columns.shape[0], buyer_columns.shape[0])
+        buyers, sellers = buyers[:, :min_len], sellers[:, :min_len]
+        rows = np.arange(offers.shape[0])[:, np.newaxis]
+        crossing = ((offers[rows, buyers] >= offers[rows, sellers]) &
+                    ~matched[rows, buyers] & ~matched[rows, sellers])
+        markets, ranks = np.nonzero(np.logical_and.accumulate(crossing, axis=1))
+        sellers, buyers = sellers[markets, ranks], buyers[markets, ranks]
+        matched[markets, buyers] = True
+        matched[markets, sellers] = True
 
-        min_len = min(seller_offers.shape[0], buyer_offers.shape[0])
-        rewards = dict((aid, 0) for aid in agents['id'].tolist())
-        for i in range(min_len):
-            considered_seller = seller_offers.iloc[i, :]
-            considered_buyer = buyer_offers.iloc[i, :]
-            if considered_buyer['offer'] >= considered_seller['offer']:
-                # if seller price is lower or equal to buyer price
-                # matching is performed
-                matched.add(considered_buyer['id'])
-                matched.add(considered_seller['id'])
-
-                # keeping both done and matched is redundant
-                done[considered_buyer['id']] = True
-                done[considered_seller['id']] = True
-
-                deal_price = random.uniform(considered_seller['offer'], considered_buyer[
-                    'offer'])
-                if self.reward_on_reference:
-                    rewards[considered_buyer['id']] = considered_buyer['res_price'] - considered_buyer['offer']
-                    rewards[considered_seller['id']] = considered_seller['offer'] - considered_seller['res_price']
-                else:
-                    rewards[considered_buyer['id']] = considered_buyer['offer'] - deal_price
-                    rewards[considered_seller['id']] = deal_price - considered_seller['offer']
-                matching = dict(Seller=considered_seller['id'], Buyer=considered_buyer['id'],
-                                time=env_time, deal_price=deal_price)
-                deal_history.append(matching)
-            else:
-                # not possible that new matches can occur after this failure due to sorting.
-                break
+        deal_prices, buyer_rewards, seller_rewards = self._settle(
+            offers[markets, sellers], offers[markets, buyers], res_prices[sellers],
+            res_prices[buyers])
+        rewards = np.zeros(offers.shape)
+        rewards[markets, buyers] = buyer_rewards
+        rewards[markets, sellers] = seller_rewards
 
-        return rewards
+        return rewards, (markets, sellers, buyers, deal_prices)
+
+    def match_book(self,
+                   book,
+                   action_idx: np.ndarray,
+                   action_values: np.ndarray,
+                   offers: np.ndarray,
+                   times: np.ndarray,
+                   res_prices: np.ndarray,
+                   matched: np.ndarray,
+                   env_time: int):
+        """
+        The clearing of a market with a persistent order book. Only the submitted offers are
+        pushed into the book, so the cost of a step grows with the number of submitted offers
+        and deals instead of the market size. The ordering, the deal prices and the rewards are
+        the same as in match_arrays.
+        Please check Matcher.match_book for the parameters.
+        """
+        # update offers of the non-matched agents
+        live = ~matched[action_idx]
+        action_idx, action_values = action_idx[live], action_values[live]
+        offers[action_idx] = action_values
+        times[action_idx] = env_time
+        for position, offer in zip(action_idx.tolist(), action_values.tolist()):
+            book.update(position, offer, env_time)
+
+        pairs = book.pop_crossing()
+        sellers = np.array([seller for seller, _ in pairs], dtype=np.intp)
+        buyers = np.array([buyer for _, buyer in pairs], dtype=np.intp)
+        matched[buyers] = True
+        matched[sellers] = True
+
+        deal_prices, buyer_rewards, seller_rewards = self._settle(
+            offers[sellers], offers[buyers], res_prices[sellers], res_prices[buyers])
+        rewards = np.zeros(offers.shape[0])
+        rewards[buyers] = buyer_rewards
+        rewards[sellers] = seller_rewards
+
+        return rewards, (sellers, buyers, deal_prices)
+
+    def _settle(self, asks, bids, seller_res_prices, buyer_res_prices):
+        """
+        Draws the deal prices of matched pairs and computes their rewards.
+        :return: a tuple of the deal prices, the buyer rewards and the seller rewards
+        """
+        # random.uniform(a, b) is a + (b - a) * random.random(), drawing the uniforms in market
+        # and pair order keeps the deal prices identical to one random.uniform call per pair
+        n_deals = asks.shape[0]
+        rng = random if self.rng is None else self.rng
+        uniforms = np.fromiter((rng.random() for _ in range(n_deals)), dtype=np.float64,
+                               count=n_deals)
+        deal_prices = asks + (bids - asks) * uniforms
+        if self.reward_on_reference:
+            return deal_prices, buyer_res_prices - bids, asks - seller_res_prices
+        return deal_prices, bids - deal_prices, deal_prices - asks
@@ -0,0 +1,124 @@
+import csv
+import os
+import time
+
+import numpy as np
+
+# the rate columns the sink adds to every row
+RATE_COLUMNS = ['episodes_per_sec', 'steps_per_sec']
+
+
+class MetricsSink:
+    def __init__(self, capacity: int = 1024, path: str = None, clock=time.perf_counter):
+        """
+        A structured replacement of the printed training statistics, for headless runs.
+        Rows of metrics are kept in a ring buffer of capacity rows, together with the running
+        episodes/sec and steps/sec since the previous row. Episodes are counted with tick.
+        The columns are the keys of the first logged row followed by RATE_COLUMNS.
+        :param capacity: the number of rows in the buffer. Without a path the oldest rows are
+        overwritten when the buffer is full.
+        :param path: an optional .csv or .npz file. A .csv file is written with the header by the
+        first flush and appended the unflushed rows when the buffer is full and by flush, so no
+        row is lost. A .npz file is written with the rows in the buffer by flush.
+        :param clock: the clock in seconds
+        """
+        if path is not None and os.path.splitext(path)[1] not in ('.csv', '.npz'):
+            raise ValueError(f"Unknown metrics file '{path}', expected a .csv or .npz file")
+        self.capacity = capacity
+        self.path = path
+        self.clock = clock
+        self.columns = None
+        self.buffer = None
+        self.n_rows = 0
+        self.n_flushed = 0
+        self._flushed_paths = set()
+        self.episodes = 0
+        self.steps = 0
+        self.start_time = clock()
+        self._last = (self.start_time, 0, 0)
+
+    def tick(self, steps: int):
+        """
+        Counts one finished episode of steps market steps.
+        """
+        self.episodes += 1
+        self.steps += steps
+
+    @property
+    def episodes_per_sec(self):
+        """
+        The episodes per second since the sink was created.
+        """
+        return self.episodes / max(self.clock() - self.start_time, 1e-12)
+
+    @property
+    def steps_per_sec(self):
+        """
+        The steps per second since the sink was created.
+        """
+        return self.steps / max(self.clock() - self.start_time, 1e-12)
+
+    def log(self, values: dict):
+        """
+        Appends a row of metrics, with the episodes/sec and steps/sec since the previous row.
+        :param values: the metrics of the row, keyed by column. Missing columns are NaN.
+        """
+        if self.columns is None:
+            self.columns = list(values) + RATE_COLUMNS
+            self.buffer = np.full((self.capacity, len(self.columns)), np.nan)
+        if self.path is not None and self.path.endswith('.csv') and \
+                self.n_rows - self.n_flushed == self.capacity:
+            self.flush()
+        now = self.clock()
+        last_time, last_episodes, last_steps = self._last
+        elapsed = max(now - last_time, 1e-12)
+        self._last = (now, self.episodes, self.steps)
+        row = self.buffer[self.n_rows % self.capacity]
+        row.fill(np.nan)
+        for i, column in enumerate(self.columns[:-len(RATE_COLUMNS)]):
+            if column in values:
+                row[i] = values[column]
+        row[-2] = (self.episodes - last_episodes) / elapsed
+        row[-1] = (self.steps - last_steps) / elapsed
+        self.n_rows += 1
+
+    def rows(self):
+        """
+        :return: the rows in the buffer, oldest first, as an array of shape (n, n_columns)
+        """
+        if self.buffer is None:
+            return np.zeros((0, 0))
+        if self.n_rows <= self.capacity:
+            return self.buffer[:self.n_rows].copy()
+        return np.roll(self.buffer, -(self.n_rows % self.capacity), axis=0)
+
+    def last(self):
+        """
+        :return: the last row as a dictionary keyed by column, None before the first row
+        """
+        if self.n_rows == 0:
+            return None
+        return dict(zip(self.columns, self.buffer[(self.n_rows - 1) % self.capacity].tolist()))
+
+    def flush(self, path: str = None):
+        """
+        Writes the rows to path (default: the path of the sink). A .csv file is written with the
+        header by the first flush and appended the rows not flushed before by the next ones, a
+        .npz file is written with the columns and all rows in the buffer.
+        """
+        path = self.path if path is None else path
+        if path is None or self.buffer is None:
+            return
+        if path.endswith('.npz'):
+            np.savez(path, columns=np.array(self.columns), rows=self.rows())
+            return
+        n_new = min(self.n_rows - self.n_flushed, self.capacity)
+        new_rows = self.rows()[-n_new:] if n_new else []
+        first = path not in self._flushed_paths
+        self._flushed_paths.add(path)
+        with open(path, 'w' if first else 'a', newline='') as f:
+            writer = csv.writer(f)
+            if first:
+                writer.writerow(self.columns)
+            writer.writerows(row.tolist() for row in new_rows)
+        self.n_flushed = self.n_rows
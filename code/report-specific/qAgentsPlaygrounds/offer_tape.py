@@ -0,0 +1,221 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# one record per agent and market step
+RECORD_DTYPE = np.dtype([('episode', np.int64), ('step', np.int32), ('agent', np.int32),
+                         ('offer', np.float64), ('matched', np.bool_)])
+# one entry per recorded episode
+INDEX_DTYPE = np.dtype([('episode', np.int64), ('chunk', np.int64), ('start', np.int64),
+                        ('count', np.int64)])
+META_FILE = 'tape.json'
+
+
+def chunk_file(chunk: int):
+    return f'offers_{chunk:06d}.dat'
+
+
+def index_file(chunk: int):
+    return f'index_{chunk:06d}.npy'
+
+
+class OfferTape:
+    def __init__(self, directory: str, agent_ids: list, episodes_per_chunk: int = 1000):
+        """
+        Records the offers of every agent after every market step into fixed-width binary files,
+        which are read back as memory-mapped arrays by OfferTapeReader.
+        A record holds the episode, the step, the agent position, the agent's last offer and
+        whether the agent is matched. The records of episodes [k * episodes_per_chunk,
+        (k + 1) * episodes_per_chunk) are appended to chunk file k. Episodes are numbered from 0 in
+        the order they are recorded, a round without any step is not recorded.
+        Every chunk has its own index file of its episodes, written when the chunk is complete and
+        by flush, so only the index of the current chunk is kept in memory and the cost of a
+        chunk does not grow with the length of the tape.
+        Pass the tape to MarketEnvironment(tape=...) to record a market.
+        :param directory: the directory of the tape, created if it does not exist
+        :param agent_ids: the agent ids in the order of the agent positions
+        :param episodes_per_chunk: the number of episodes per chunk file
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.agent_ids = list(agent_ids)
+        self.episodes_per_chunk = episodes_per_chunk
+        self.n_episodes = 0
+        self.n_records = 0
+        self.closed = False
+        # the index of the current chunk, with one entry per episode
+        self._index = np.zeros(episodes_per_chunk, dtype=INDEX_DTYPE)
+        self._counts = self._index['count']
+        self._chunk_episodes = 0
+        self._chunk = -1
+        self._chunk_records = 0
+        self._file = None
+        self._in_episode = False
+        self._records = np.zeros(len(self.agent_ids), dtype=RECORD_DTYPE)
+        self._records['agent'] = np.arange(len(self.agent_ids))
+
+    def new_episode(self):
+        """
+        Ends the current episode, the next recorded step starts a new one.
+        """
+        self._in_episode = False
+
+    def record(self, step: int, offers: np.ndarray, matched: np.ndarray):
+        """
+        Appends the records of one market step.
+        :param step: the time step of the market
+        :param offers: the last offer per agent position
+        :param matched: the matched mask per agent position
+        """
+        if self.closed:
+            raise ValueError('The offer tape is closed')
+        if not self._in_episode:
+            self._start_episode()
+        records = self._records
+        records['episode'] = self.n_episodes - 1
+        records['step'] = step
+        records['offer'] = offers
+        records['matched'] = matched
+        self._file.write(records.data)
+        self._counts[self._chunk_episodes - 1] += records.shape[0]
+        self._chunk_records += records.shape[0]
+        self.n_records += records.shape[0]
+
+    def flush(self):
+        """
+        Writes the buffered records and the index of the current chunk to disk.
+        """
+        if self._file is not None:
+            self._file.flush()
+        self._write_index()
+
+    def close(self):
+        """
+        Writes the buffered records and the index and closes the chunk file.
+        """
+        if self.closed:
+            return
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start_episode(self):
+        episode = self.n_episodes
+        chunk = episode // self.episodes_per_chunk
+        if chunk != self._chunk:
+            if self._file is not None:
+                self._file.close()
+                self._write_index()
+            self._chunk = chunk
+            self._chunk_records = 0
+            self._chunk_episodes = 0
+            self._file = open(os.path.join(self.directory, chunk_file(chunk)), 'wb')
+        self._index[self._chunk_episodes] = (episode, chunk, self._chunk_records, 0)
+        self._chunk_episodes += 1
+        self.n_episodes += 1
+        self._in_episode = True
+
+    def _write_index(self):
+        if self._chunk >= 0:
+            np.save(os.path.join(self.directory, index_file(self._chunk)),
+                    self._index[:self._chunk_episodes])
+        meta = dict(agent_ids=self.agent_ids, episodes_per_chunk=self.episodes_per_chunk,
+                    record_dtype=RECORD_DTYPE.descr, n_episodes=self.n_episodes,
+                    n_records=self.n_records, n_chunks=self._chunk + 1)
+        with open(os.path.join(self.directory, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+class OfferTapeReader:
+    def __init__(self, directory: str):
+        """
+        Reads an offer tape written by OfferTape. The chunk files are memory-mapped and the index
+        of a chunk is loaded on first access, so only the chunks that are read are loaded.
+        :param directory: the directory of the tape
+        """
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        self.agent_ids = meta['agent_ids']
+        self.episodes_per_chunk = meta['episodes_per_chunk']
+        self.n_episodes = meta['n_episodes']
+        self.n_chunks = meta['n_chunks']
+        self._indexes = dict()
+        self._chunks = dict()
+
+    def __len__(self):
+        return self.n_episodes
+
+    def episode(self, episode: int):
+        """
+        :param episode: the number of the episode
+        :return: the records of the episode, a read-only memory-mapped array of RECORD_DTYPE
+        """
+        if not 0 <= episode < self.n_episodes:
+            raise IndexError(f'The tape has no episode {episode}')
+        chunk, entry = divmod(episode, self.episodes_per_chunk)
+        _, _, start, count = self.chunk_index(chunk)[entry].tolist()
+        return self.chunk(chunk)[start:start + count]
+
+    def chunk_index(self, chunk: int):
+        """
+        :param chunk: the number of the chunk
+        :return: the index of the episodes of the chunk, an array of INDEX_DTYPE
+        """
+        index = self._indexes.get(chunk)
+        if index is None:
+            if not 0 <= chunk < self.n_chunks:
+                raise IndexError(f'The tape has no chunk {chunk}')
+            index = np.load(os.path.join(self.directory, index_file(chunk)))
+            self._indexes[chunk] = index
+        return index
+
+    @property
+    def index(self):
+        """
+        :return: the index of all episodes, an array of INDEX_DTYPE. All chunk indexes are loaded.
+        """
+        return np.concatenate([self.chunk_index(chunk) for chunk in range(self.n_chunks)] or
+                              [np.zeros(0, dtype=INDEX_DTYPE)])
+
+    def chunk(self, chunk: int):
+        """
+        :param chunk: the number of the chunk
+        :return: the indexed records of the chunk, a read-only memory-mapped array of RECORD_DTYPE
+        """
+        records = self._chunks.get(chunk)
+        if records is None:
+            entries = self.chunk_index(chunk)
+            count = int(entries['start'][-1] + entries['count'][-1])
+            records = np.memmap(os.path.join(self.directory, chunk_file(chunk)),
+                                dtype=RECORD_DTYPE, mode='r', shape=(count,))
+            self._chunks[chunk] = records
+        return records
+
+    def chunks(self):
+        """
+        Streams the tape chunk by chunk.
+        :return: a generator of (chunk number, records) pairs
+        """
+        for chunk in range(self.n_chunks):
+            yield chunk, self.chunk(chunk)
+
+    def frame(self, episode: int):
+        """
+        :param episode: the number of the episode
+        :return: a DataFrame of the records of the episode, with the agent ids in the column id
+        """
+        records = self.episode(episode)
+        frame = pd.DataFrame(np.asarray(records))
+        frame.insert(3, 'id', np.asarray(self.agent_ids, dtype=object)[records['agent']])
+        return frame
@@ -0,0 +1,123 @@
+import heapq
+
+import numpy as np
+
+
+class OrderBook:
+    def __init__(self, is_buyer):
+        """
+        A persistent order book over the agents of one market, which keeps the unmatched offers
+        sorted across steps.
+        Bids are ordered by descending offer, asks by ascending offer, and ties are broken by
+        ascending offer time and then by agent position, which is the order of the stable
+        (offer, time) sort of the matcher. Both sides are binary heaps of (key, time, position)
+        entries with lazy deletion: an update pushes a new entry in O(log n) and a removal only
+        forgets the current entry of the agent in O(1). Entries that are no longer current are
+        dropped when they reach the top, and the heaps are rebuilt when they hold too many of them.
+        :param is_buyer: boolean mask over the agent positions, true for buyers and false for sellers
+        """
+        self.is_buyer = [bool(x) for x in is_buyer]
+        self.n_agents = len(self.is_buyer)
+        self.bids = []
+        self.asks = []
+        # the current heap entry of every agent, None for agents that are not in the book
+        self.entries = [None] * self.n_agents
+
+    def reset(self, offers, times):
+        """
+        Fills the book with the offers of all agents.
+        :param offers: the offer per agent position
+        :param times: the time step of the offer per agent position
+        """
+        self.entries = [self._entry(position, offer, time)
+                        for position, (offer, time) in
+                        enumerate(zip(np.asarray(offers).tolist(), np.asarray(times).tolist()))]
+        self._rebuild()
+
+    def snapshot(self):
+        """
+        :return: a copy of the content of the book, which can be restored with restore
+        """
+        return list(self.entries), list(self.bids), list(self.asks)
+
+    def restore(self, snapshot):
+        """
+        Restores the content of the book from a snapshot, without sorting the offers again.
+        The snapshot is not modified, so it can be restored any number of times.
+        :param snapshot: the result of snapshot
+        """
+        entries, bids, asks = snapshot
+        self.entries = list(entries)
+        self.bids = list(bids)
+        self.asks = list(asks)
+
+    def update(self, position: int, offer: float, time: int):
+        """
+        Sets the offer of an agent that is in the book.
+        :param position: the agent position
+        :param offer: the new offer
+        :param time: the time step of the new offer
+        """
+        if self.entries[position] is None:
+            return
+        entry = self._entry(position, offer, time)
+        self.entries[position] = entry
+        heapq.heappush(self.bids if self.is_buyer[position] else self.asks, entry)
+        if len(self.bids) + len(self.asks) > 2 * self.n_agents + 64:
+            self._rebuild()
+
+    def remove(self, position: int):
+        """
+        Takes an agent out of the book, e.g. after it has been matched.
+        :param position: the agent position
+        """
+        self.entries[position] = None
+
+    def best_bid(self):
+        """
+        :return: the position of the buyer with the best bid, None if there is no buyer left
+        """
+        entry = self._top(self.bids)
+        return None if entry is None else entry[2]
+
+    def best_ask(self):
+        """
+        :return: the position of the seller with the best ask, None if there is no seller left
+        """
+        entry = self._top(self.asks)
+        return None if entry is None else entry[2]
+
+    def pop_crossing(self):
+        """
+        Removes the best bid and the best ask from the book for as long as the bid is greater or
+        equal to the ask.
+        :return: the list of (seller position, buyer position) pairs, in matching order
+        """
+        pairs = []
+        while True:
+            bid = self._top(self.bids)
+            ask = self._top(self.asks)
+            if bid is None or ask is None or -bid[0] < ask[0]:
+                return pairs
+            heapq.heappop(self.bids)
+            heapq.heappop(self.asks)
+            self.entries[bid[2]] = None
+            self.entries[ask[2]] = None
+            pairs.append((ask[2], bid[2]))
+
+    def _entry(self, position, offer, time):
+        return (-offer if self.is_buyer[position] else offer, time, position)
+
+    def _top(self, heap):
+        entries = self.entries
+        while heap and entries[heap[0][2]] is not heap[0]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _rebuild(self):
+        self.bids = [entry for entry in self.entries
+                     if entry is not None and self.is_buyer[entry[2]]]
+        self.asks = [entry for entry in self.entries
+                     if entry is not None and not self.is_buyer[entry[2]]]
+        heapq.heapify(self.bids)
+        heapq.heapify(self.asks)
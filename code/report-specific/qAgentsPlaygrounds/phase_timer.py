@@ -0,0 +1,91 @@
+import time
+
+import numpy as np
+
+# a duration of d nanoseconds falls into bin d.bit_length(), i.e. [2 ** (k - 1), 2 ** k) ns
+N_BINS = 64
+PERCENTILES = [50, 90, 99]
+
+
+class PhaseTimer:
+    def __init__(self, clock=time.perf_counter_ns):
+        """
+        Aggregates the durations of named phases, e.g. the phases of a training episode, into
+        histograms with power-of-two bins in nanoseconds. A window holds the phases since the
+        last report, the totals hold all of them.
+        Timing a phase costs two clock reads and a few integer operations. The code paths that
+        accept a timer take None to skip the timing altogether.
+        :param clock: the clock in integer nanoseconds
+        """
+        self.clock = clock
+        self.window = dict()
+        self.totals = dict()
+
+    def lap(self, phase: str, start: int):
+        """
+        Records the phase from start until now.
+        :param phase: the name of the phase
+        :param start: the clock reading at the start of the phase
+        :return: the clock reading at the end of the phase, to start the next phase from
+        """
+        now = self.clock()
+        elapsed = now - start
+        for phases in (self.window, self.totals):
+            histogram = phases.get(phase)
+            if histogram is None:
+                histogram = phases[phase] = [0] * (N_BINS + 2)
+            histogram[elapsed.bit_length()] += 1
+            # the last two entries hold the count and the sum of the durations
+            histogram[N_BINS] += 1
+            histogram[N_BINS + 1] += elapsed
+        return now
+
+    def histograms(self, window: bool = False):
+        """
+        :param window: the histograms of the current window instead of the totals
+        :return: a dictionary of the phase name and the count per bin, bin k holding the
+        durations in [2 ** (k - 1), 2 ** k) nanoseconds
+        """
+        phases = self.window if window else self.totals
+        return dict((phase, np.array(histogram[:N_BINS], dtype=np.int64))
+                    for phase, histogram in phases.items())
+
+    def summary(self, window: bool = False):
+        """
+        :param window: summarize the current window instead of the totals
+        :return: a dictionary per phase with the count, the total and mean duration in
+        milliseconds and microseconds, the share of the timed total, and the percentiles of the
+        durations in microseconds, as the upper bounds of their histogram bins
+        """
+        phases = self.window if window else self.totals
+        timed = sum(histogram[N_BINS + 1] for histogram in phases.values())
+        summary = dict()
+        for phase, histogram in phases.items():
+            count, total = histogram[N_BINS], histogram[N_BINS + 1]
+            stats = dict(count=count, total_ms=total / 1e6, mean_us=total / count / 1e3,
+                         share=total / timed if timed else 0.)
+            cumulative = np.cumsum(histogram[:N_BINS])
+            for q in PERCENTILES:
+                k = int(np.searchsorted(cumulative, count * q / 100))
+                stats[f'p{q}_us'] = 2 ** k / 1e3
+            summary[phase] = stats
+        return summary
+
+    def report(self, window: bool = True):
+        """
+        :param window: report the current window instead of the totals
+        :return: a table of the summary, one line per phase
+        """
+        lines = [f"{'phase':<16}{'count':>9}{'total ms':>11}{'share':>8}{'mean us':>10}"
+                 + ''.join(f'{f"<p{q} us":>10}' for q in PERCENTILES)]
+        for phase, stats in self.summary(window).items():
+            lines.append(f"{phase:<16}{stats['count']:>9}{stats['total_ms']:>11.1f}"
+                         f"{stats['share']:>8.1%}{stats['mean_us']:>10.1f}"
+                         + ''.join(f"{stats[f'p{q}_us']:>10.1f}" for q in PERCENTILES))
+        return '\n'.join(lines)
+
+    def next_window(self):
+        """
+        Starts a new window, the totals are kept.
+        """
+        self.window = dict()
@@ -0,0 +1,208 @@
+import cProfile
+import io
+import os
+import pstats
+import signal
+from collections import Counter
+
+# RLFM_PROFILE=1000:1100 profiles the episodes 1000 to 1099 of a training or test run
+PROFILE_ENV = 'RLFM_PROFILE'
+# the output directory, 'sample' or 'cprofile', and the number of functions in the summary
+PROFILE_DIR_ENV = 'RLFM_PROFILE_DIR'
+PROFILE_MODE_ENV = 'RLFM_PROFILE_MODE'
+PROFILE_TOP_ENV = 'RLFM_PROFILE_TOP'
+MODES = ('cprofile', 'sample')
+
+
+def _label(code):
+    '''
+    The frame label of a function in the collapsed stacks: function (file:line).
+    '''
+    filename, line, name = code
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+
+class EpisodeProfiler:
+    def __init__(self, start: int, stop: int, directory: str = '.', mode: str = 'cprofile',
+                 top: int = 25, interval: float = 0.001, label: str = None):
+        """
+        Profiles the episodes start <= episode < stop of a run. The run calls episode at the start
+        of every episode and close after the last one.
+        The profile is written into directory as {path}.collapsed, the collapsed stacks
+        ('frame;frame;frame weight' per line, the input of flamegraph.pl and speedscope), and
+        {path}.txt, the top functions by own and cumulative time, see path for the file name.
+        The 'cprofile' mode also writes the cProfile statistics as {path}.pstats.
+        :param start: the first profiled episode
+        :param stop: the episode after the last profiled one
+        :param directory: the output directory, created if it does not exist
+        :param mode: 'cprofile' traces every call with cProfile, its stacks are reconstructed
+        from the call graph, with weights in microseconds. 'sample' samples the stack of the main
+        thread every interval seconds of CPU time, its weights are sample counts. Sampling has a
+        lower overhead and exact stacks, but needs signal.setitimer (not on Windows).
+        :param top: the number of functions in the summary
+        :param interval: the sampling interval in seconds of the 'sample' mode
+        :param label: names the run in the file name, e.g. the job of runner.run_job, so that the
+        profiles of several runs in one process or directory are kept apart
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiler mode '{mode}', expected one of {MODES}")
+        if mode == 'sample' and not hasattr(signal, 'setitimer'):
+            raise ValueError("The 'sample' mode requires signal.setitimer")
+        self.start = start
+        self.stop = stop
+        self.directory = directory
+        self.mode = mode
+        self.top = top
+        self.interval = interval
+        self.label = label
+        self.running = False
+        self.finished = False
+        self._profile = None
+        self._samples = Counter()
+        self._previous_handler = None
+
+    @classmethod
+    def from_env(cls, environ=os.environ, label: str = None):
+        '''
+        Builds a profiler from the RLFM_PROFILE variables, or returns None if RLFM_PROFILE is
+        not set. RLFM_PROFILE is start:stop, RLFM_PROFILE_DIR, RLFM_PROFILE_MODE and
+        RLFM_PROFILE_TOP set the directory, the mode and the summary length. label names the
+        run, see the constructor.
+        '''
+        window = environ.get(PROFILE_ENV)
+        if not window:
+            return None
+        start, _, stop = window.partition(':')
+        start = int(start)
+        stop = int(stop) if stop else start + 1
+        return cls(start, stop, directory=environ.get(PROFILE_DIR_ENV, '.'),
+                   mode=environ.get(PROFILE_MODE_ENV, 'cprofile'),
+                   top=int(environ.get(PROFILE_TOP_ENV, 25)), label=label)
+
+    @property
+    def path(self):
+        """
+        The output path without the extension: profile_{start}-{stop}_{label}_{pid}, without
+        the label if there is none. The process id keeps apart the processes that inherit
+        RLFM_PROFILE, e.g. misc/train.py and misc/test.py, the label the runs of one process,
+        e.g. the jobs of a runner.run_experiments worker, which runs several jobs.
+        """
+        label = '' if self.label is None else f'_{self.label}'
+        return os.path.join(self.directory,
+                            f'profile_{self.start}-{self.stop}{label}_{os.getpid()}')
+
+    def episode(self, episode: int):
+        """
+        Starts profiling at the first and stops it at the end of the last profiled episode.
+        :param episode: the episode that starts now
+        """
+        if self.running and episode >= self.stop:
+            self.close()
+        elif not self.running and not self.finished and self.start <= episode < self.stop:
+            self._begin()
+
+    def close(self):
+        """
+        Stops a running profile and writes it.
+        """
+        if not self.running:
+            return
+        if self.mode == 'cprofile':
+            self._profile.disable()
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler)
+        self.running = False
+        self.finished = True
+        self._write()
+
+    def _begin(self):
+        self.running = True
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        self._samples[tuple(reversed(stack))] += 1
+
+    def _write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.mode == 'cprofile':
+            self._profile.dump_stats(self.path + '.pstats')
+            stats = pstats.Stats(self._profile)
+            collapsed = collapse_stats(stats.stats)
+            summary = io.StringIO()
+            for sort in ('tottime', 'cumulative'):
+                stats.stream = summary
+                stats.sort_stats(sort).print_stats(self.top)
+        else:
+            collapsed = dict((';'.join(_label(code) for code in stack), count)
+                             for stack, count in self._samples.items())
+            summary = io.StringIO()
+            summary.write(summarize_samples(self._samples, self.top))
+        with open(self.path + '.collapsed', 'w') as f:
+            for stack, weight in sorted(collapsed.items()):
+                if weight >= 1:
+                    f.write(f'{stack} {int(round(weight))}\n')
+        with open(self.path + '.txt', 'w') as f:
+            f.write(f'Episodes {self.start} to {self.stop - 1}, mode {self.mode}\n')
+            f.write(summary.getvalue())
+
+
+def collapse_stats(stats: dict, min_weight: float = 1.):
+    '''
+    Reconstructs collapsed stacks from the call graph of cProfile statistics (pstats.Stats.stats).
+    The time of a function is split among its callers in proportion to the time spent in it per
+    caller, from the functions without callers down. Recursive calls end a stack. cProfile does
+    not see the functions that were running when the profile started, e.g. the training loop, so
+    the stacks start with the functions they call.
+    Stacks below min_weight microseconds of total time are cut off.
+    Returns a dictionary of the stack ('frame;frame') and its own time in microseconds.
+    '''
+    callees = dict()
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((function, caller_stats[3]))
+    collapsed = Counter()
+
+    def walk(function, stack, weight):
+        _, _, own_time, total_time, _ = stats[function]
+        stack = stack + [function]
+        collapsed[';'.join(_label(code) for code in stack)] += own_time * weight * 1e6
+        for callee, time_from_caller in callees.get(function, []):
+            callee_total = stats[callee][3]
+            callee_weight = weight * time_from_caller / callee_total if callee_total else 0.
+            if callee not in stack and callee_weight * callee_total * 1e6 >= min_weight:
+                walk(callee, stack, callee_weight)
+
+    for function, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            walk(function, [], 1.)
+    return collapsed
+
+
+def summarize_samples(samples: Counter, top: int = 25):
+    '''
+    Returns the top functions of stack samples by own samples (the function is at the top of the
+    stack) and by total samples (the function is on the stack), as a text table.
+    '''
+    n_samples = sum(samples.values())
+    own, total = Counter(), Counter()
+    for stack, count in samples.items():
+        own[stack[-1]] += count
+        for code in set(stack):
+            total[code] += count
+    lines = [f'{n_samples} samples']
+    for title, counter in (('own', own), ('total', total)):
+        lines.append(f"\n{'samples':>9}{'share':>8}  function ({title})")
+        for code, count in counter.most_common(top):
+            lines.append(f'{count:>9}{count / max(n_samples, 1):>8.1%}  {_label(code)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class AgentRegistry:
+    def __init__(self, agent_ids: list):
+        """
+        Maps the agent ids of a market to dense integer indices, once at construction. The index
+        of an agent is its position in the market (sellers first, then buyers), so that the
+        per-agent arrays of the environment, the matcher and the information settings can be
+        indexed directly. Dictionaries keyed by agent id are only built at the boundary of the
+        public API, with to_dict.
+        :param agent_ids: the agent ids in the order of the agent positions
+        """
+        self.ids = list(agent_ids)
+        self.index = dict((agent_id, i) for i, agent_id in enumerate(self.ids))
+        self.n_agents = len(self.ids)
+
+    def __len__(self):
+        return self.n_agents
+
+    def positions(self, agent_ids):
+        """
+        :param agent_ids: an iterable of agent ids
+        :return: the positions of the agents as an integer array, -1 for unknown ids
+        """
+        index = self.index
+        return np.fromiter((index.get(agent_id, -1) for agent_id in agent_ids), dtype=np.intp)
+
+    def scatter(self, values: dict, fill=np.nan, out: np.ndarray = None):
+        """
+        Writes a dictionary keyed by agent id into an array indexed by agent position.
+        Values of unknown agent ids are ignored.
+        :param values: the value per agent id, e.g. the offers of a market step
+        :param fill: the value of the agents missing from values, NaN marks a missing offer
+        :param out: an optional array of length n_agents that is filled and returned
+        :return: the array of values per agent position
+        """
+        if out is None:
+            out = np.empty(self.n_agents, dtype=np.float64)
+        out.fill(fill)
+        index = self.index
+        for agent_id, value in values.items():
+            position = index.get(agent_id)
+            if position is not None:
+                out[position] = value
+        return out
+
+    def to_dict(self, values):
+        """
+        :param values: an array or sequence of values per agent position, the rows of a 2-D
+        array are kept as arrays
+        :return: a dictionary of the values keyed by agent id
+        """
+        if isinstance(values, np.ndarray) and values.ndim == 1:
+            values = values.tolist()
+        return dict(zip(self.ids, values))
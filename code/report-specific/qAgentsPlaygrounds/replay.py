@@ -0,0 +1,351 @@
+import argparse
+import functools
+import json
+import random
+from collections.abc import Mapping
+
+import numpy as np
+
+import info_settings
+import matchers
+from agents import Buyer, Seller
+from environments import MarketEnvironment
+
+# the per-step outputs compared by replay, in the order they are checked
+FIELDS = ('draws', 'deal_sellers', 'deal_buyers', 'deal_prices', 'rewards', 'done',
+          'terminated', 'truncated', 'states')
+
+
+class _RecordingRandom:
+    def __init__(self, rng, draws: list):
+        """
+        Draws from rng, or the global random module if rng is None, and appends every draw to
+        draws.
+        """
+        self.rng = rng
+        self.draws = draws
+
+    def random(self):
+        draw = (random if self.rng is None else self.rng).random()
+        self.draws.append(draw)
+        return draw
+
+
+class _ReplayRandom:
+    def __init__(self, draws: np.ndarray):
+        """
+        Returns the recorded draws in order from the cursor. Past the end of the recording it
+        returns NaN, which replay reports as a divergence of the draw count.
+        """
+        self.draws = draws.tolist()
+        self.cursor = 0
+
+    def random(self):
+        cursor = self.cursor
+        self.cursor += 1
+        return self.draws[cursor] if cursor < len(self.draws) else float('nan')
+
+
+class MarketRecording:
+    def __init__(self, meta: dict, arrays: dict):
+        """
+        A recorded run of a market, stored column-wise: one row per market step for the actions
+        and the outputs, and the matcher draws and the deals of all steps concatenated, with the
+        offsets of every episode and step.
+        :param meta: the description of the market: agent ids, roles and reservation prices,
+        max_steps, the setting and the matcher, and the engine of the recording
+        :param arrays: the arrays of the recording, see MarketRecorder.recording
+        """
+        self.meta = meta
+        self.arrays = arrays
+        self.episode_starts = arrays['episode_starts']
+        self.n_episodes = self.episode_starts.shape[0] - 1
+        self.n_steps = int(self.episode_starts[-1])
+
+    def __len__(self):
+        return self.n_episodes
+
+    def steps(self, episode: int):
+        """
+        :param episode: the number of the episode
+        :return: the range of the rows of the episode's steps
+        """
+        if not 0 <= episode < self.n_episodes:
+            raise IndexError(f'The recording has no episode {episode}')
+        return range(int(self.episode_starts[episode]), int(self.episode_starts[episode + 1]))
+
+    def step(self, row: int):
+        """
+        :param row: the row of the step
+        :return: a dictionary of the recorded outputs of the step, keyed by FIELDS
+        """
+        arrays = self.arrays
+        draws = slice(arrays['draw_starts'][row], arrays['draw_starts'][row + 1])
+        deals = slice(arrays['deal_starts'][row], arrays['deal_starts'][row + 1])
+        outputs = dict(draws=arrays['draws'][draws],
+                       deal_sellers=arrays['deal_sellers'][deals],
+                       deal_buyers=arrays['deal_buyers'][deals],
+                       deal_prices=arrays['deal_prices'][deals],
+                       rewards=arrays['rewards'][row], done=arrays['done'][row],
+                       terminated=arrays['terminated'][row], truncated=arrays['truncated'][row])
+        if 'states' in arrays:
+            outputs['states'] = arrays['states'][row]
+        return outputs
+
+    def save(self, path: str):
+        """
+        Writes the recording into an .npz file.
+        """
+        np.savez_compressed(path, meta=np.array(json.dumps(self.meta)), **self.arrays)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Reads a recording written by save.
+        """
+        with np.load(path) as data:
+            arrays = dict((name, data[name]) for name in data.files if name != 'meta')
+            meta = json.loads(str(data['meta']))
+        return cls(meta, arrays)
+
+
+class MarketRecorder:
+    def __init__(self, record_states: bool = True):
+        """
+        Records a market for a deterministic replay: the offers of every step, the uniform draws
+        of the matcher and the outputs of the step (deals, rewards, done flags, terminated and
+        truncated, and the states), together with the initial round of the market.
+        Pass the recorder to MarketEnvironment(recorder=...) to record the market, e.g. the market
+        of a whole utils.learn run, then call recording to get a MarketRecording.
+        Episodes are started lazily, a round without any step is not recorded.
+        :param record_states: record the states of every step in the eager state mode. The states
+        of the 'lazy' and 'none' state modes are never recorded.
+        """
+        self.record_states = record_states
+        self.market_env = None
+        self.meta = None
+        self._episode_starts = []
+        self._in_episode = False
+        self._draws = []
+        self._draw_starts = [0]
+        self._deal_starts = [0]
+        self._deal_size = 0
+        self._rows = dict((name, []) for name in ('offers', 'rewards', 'done', 'terminated',
+                                                  'truncated', 'states', 'deal_sellers',
+                                                  'deal_buyers', 'deal_prices'))
+
+    def attach(self, market_env):
+        """
+        Called by the market environment on construction. Takes the description and the initial
+        round of the market and routes the draws of the matcher through the recorder.
+        """
+        if self.market_env is not None:
+            raise ValueError('The recorder is attached to a market already')
+        matcher = market_env.matcher
+        self.market_env = market_env
+        self.meta = dict(agent_ids=list(market_env.agent_id_list),
+                         is_buyer=market_env.is_buyer.tolist(),
+                         res_prices=market_env.res_prices.tolist(),
+                         max_steps=market_env.max_steps,
+                         setting=type(market_env.setting).__name__,
+                         setting_arguments=market_env.setting.arguments(),
+                         matcher=type(matcher).__name__,
+                         reward_on_reference=getattr(matcher, 'reward_on_reference', None),
+                         engine=market_env.engine,
+                         order_book=market_env.order_book is not None,
+                         state_mode=market_env.state_mode)
+        self._initial_offers = market_env._initial_offers.copy()
+        self._initial_times = market_env._initial_times.copy()
+        if hasattr(matcher, 'rng'):
+            matcher.rng = _RecordingRandom(matcher.rng, self._draws)
+
+    def new_episode(self):
+        """
+        Ends the current episode, the next recorded step starts a new one.
+        """
+        self._in_episode = False
+        self._deal_size = 0
+
+    def record_step(self, actions, rewards, done: np.ndarray, info: dict, states):
+        """
+        Appends one market step. Dictionaries keyed by agent id are stored by agent position.
+        :param actions: the offers of the step, a dictionary or an array with NaN for no offer
+        :param rewards: the rewards of the step, a dictionary or an array
+        :param done: the done mask of the agents
+        :param info: the info dictionary of the step
+        :param states: the states returned by the step
+        """
+        registry = self.market_env.registry
+        if not self._in_episode:
+            self._episode_starts.append(len(self._rows['offers']))
+            self._in_episode = True
+        if isinstance(actions, dict):
+            actions = registry.scatter(actions)
+        if isinstance(rewards, dict):
+            rewards = registry.scatter(rewards, fill=0.)
+        rows = self._rows
+        rows['offers'].append(np.array(actions, dtype=np.float64))
+        rows['rewards'].append(np.array(rewards, dtype=np.float64))
+        rows['done'].append(np.array(done, dtype=bool))
+        rows['terminated'].append(info['terminated'])
+        rows['truncated'].append(info['truncated'])
+        if self.record_states and self.market_env.state_mode == 'eager':
+            if isinstance(states, Mapping):
+                states = np.stack([states[agent_id] for agent_id in registry.ids])
+            rows['states'].append(np.array(states, dtype=self.market_env.setting.dtype))
+        ledger = self.market_env.deal_history
+        rows['deal_sellers'].append(ledger.sellers[self._deal_size:].copy())
+        rows['deal_buyers'].append(ledger.buyers[self._deal_size:].copy())
+        rows['deal_prices'].append(ledger.prices[self._deal_size:].copy())
+        self._deal_size = len(ledger)
+        self._deal_starts.append(self._deal_starts[-1] + rows['deal_prices'][-1].shape[0])
+        self._draw_starts.append(len(self._draws))
+
+    def recording(self):
+        """
+        :return: a MarketRecording of the steps recorded so far
+        """
+        rows = self._rows
+        n_agents = len(self.meta['agent_ids'])
+        n_steps = len(rows['offers'])
+
+        def stack(name, dtype):
+            if not rows[name]:
+                return np.zeros((0, n_agents), dtype=dtype)
+            return np.stack(rows[name]).astype(dtype, copy=False)
+
+        def concatenate(name, dtype):
+            if not rows[name]:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate(rows[name]).astype(dtype, copy=False)
+
+        arrays = dict(episode_starts=np.array(self._episode_starts + [n_steps], dtype=np.int64),
+                      initial_offers=self._initial_offers, initial_times=self._initial_times,
+                      offers=stack('offers', np.float64), rewards=stack('rewards', np.float64),
+                      done=stack('done', bool),
+                      terminated=np.array(rows['terminated'], dtype=bool),
+                      truncated=np.array(rows['truncated'], dtype=bool),
+                      draw_starts=np.array(self._draw_starts, dtype=np.int64),
+                      draws=np.array(self._draws, dtype=np.float64),
+                      deal_starts=np.array(self._deal_starts, dtype=np.int64),
+                      deal_sellers=concatenate('deal_sellers', np.intp),
+                      deal_buyers=concatenate('deal_buyers', np.intp),
+                      deal_prices=concatenate('deal_prices', np.float64))
+        if rows['states'] and len(rows['states']) == n_steps:
+            arrays['states'] = np.stack(rows['states'])
+        return MarketRecording(dict(self.meta), arrays)
+
+
+def make_market(recording: MarketRecording, engine='array', order_book=False, state_mode=None):
+    '''
+    Builds a market environment with the agents, the setting and the matcher of a recording.
+    The setting is built with the recorded constructor arguments.
+    The state mode defaults to 'eager' if the recording has states and to 'none' otherwise.
+    '''
+    meta = recording.meta
+    sellers, buyers = [], []
+    for agent_id, is_buyer, res_price in zip(meta['agent_ids'], meta['is_buyer'],
+                                             meta['res_prices']):
+        if is_buyer:
+            buyers.append(Buyer(agent_id, res_price))
+        else:
+            sellers.append(Seller(agent_id, res_price))
+    matcher_class = getattr(matchers, meta['matcher'])
+    matcher = (matcher_class() if meta['reward_on_reference'] is None else
+               matcher_class(reward_on_reference=meta['reward_on_reference']))
+    setting = getattr(info_settings, meta['setting'])
+    # recordings of older versions have no setting arguments
+    if meta.get('setting_arguments'):
+        setting = functools.partial(setting, **meta['setting_arguments'])
+    if state_mode is None:
+        state_mode = 'eager' if 'states' in recording.arrays else 'none'
+    return MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=meta['max_steps'],
+                             matcher=matcher, setting=setting,
+                             engine=engine, order_book=order_book, state_mode=state_mode)
+
+
+def _equal(expected, actual):
+    expected, actual = np.asarray(expected), np.asarray(actual)
+    return expected.shape == actual.shape and np.array_equal(expected, actual, equal_nan=True)
+
+
+def replay(recording: MarketRecording, market_env=None, episodes=None):
+    '''
+    Re-executes recorded episodes on market_env (default: make_market with the array engine):
+    the recorded offers are submitted with step_arrays and the matcher is fed the recorded draws,
+    so no agent code runs. The outputs of every step are compared bit for bit with the recording,
+    the states only if both have them.
+    episodes is an episode number, an iterable of episode numbers or None for all episodes.
+    Returns None if the replay is identical, otherwise a dictionary with the episode, the step
+    within the episode, the first diverging field and its expected and actual values.
+    '''
+    if market_env is None:
+        market_env = make_market(recording)
+    if episodes is None:
+        episodes = range(recording.n_episodes)
+    elif isinstance(episodes, int):
+        episodes = [episodes]
+    arrays = recording.arrays
+    matcher = market_env.matcher
+    has_rng = hasattr(matcher, 'rng')
+    if has_rng:
+        previous_rng = matcher.rng
+        matcher.rng = _ReplayRandom(arrays['draws'])
+    try:
+        for episode in episodes:
+            if not (_equal(arrays['initial_offers'], market_env._initial_offers) and
+                    _equal(arrays['initial_times'], market_env._initial_times)):
+                return dict(episode=episode, step=0, field='initial',
+                            expected=arrays['initial_offers'], actual=market_env._initial_offers)
+            market_env.reset_arrays()
+            rows = recording.steps(episode)
+            for row in rows:
+                deal_start = len(market_env.deal_history)
+                if has_rng:
+                    matcher.rng.cursor = int(arrays['draw_starts'][row])
+                states, rewards, done, info = market_env.step_arrays(arrays['offers'][row])
+                ledger = market_env.deal_history
+                actual = dict(deal_sellers=ledger.sellers[deal_start:],
+                              deal_buyers=ledger.buyers[deal_start:],
+                              deal_prices=ledger.prices[deal_start:], rewards=rewards, done=done,
+                              terminated=info['terminated'], truncated=info['truncated'])
+                if has_rng:
+                    actual['draws'] = arrays['draws'][arrays['draw_starts'][row]:
+                                                      matcher.rng.cursor]
+                if isinstance(states, np.ndarray):
+                    actual['states'] = states
+                expected = recording.step(row)
+                for field in FIELDS:
+                    if field in actual and field in expected and \
+                            not _equal(expected[field], actual[field]):
+                        return dict(episode=episode, step=row - rows.start, field=field,
+                                    expected=expected[field], actual=actual[field])
+    finally:
+        if has_rng:
+            matcher.rng = previous_rng
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replays a market recording against an engine '
+                                                 'and reports the first diverging step.')
+    parser.add_argument('recording', help='an .npz file written by MarketRecording.save')
+    parser.add_argument('--engine', default='array', choices=['pandas', 'array', 'array+book'])
+    parser.add_argument('--episodes', type=int, nargs='+', default=None)
+    args = parser.parse_args(argv)
+
+    recording = MarketRecording.load(args.recording)
+    market_env = make_market(recording, engine=args.engine.split('+')[0],
+                             order_book=args.engine == 'array+book')
+    divergence = replay(recording, market_env, args.episodes)
+    if divergence is None:
+        print(f'identical: {recording.n_episodes} episodes, {recording.n_steps} steps')
+    else:
+        print(f"diverged at episode {divergence['episode']} step {divergence['step']} in "
+              f"{divergence['field']}: expected {divergence['expected']}, got {divergence['actual']}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,155 @@
+import os
+import pickle
+import random
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import info_settings
+from environments import MarketEnvironment
+from matchers import RandomMatcher
+from metrics import MetricsSink
+from offer_tape import OfferTape
+from profiling import EpisodeProfiler
+from utils import get_agents_equal, learn
+
+# Configuration of the qAgentsPlaygrounds notebook, a job config overrides any of these keys
+DEFAULT_CONFIG = dict(
+    agents=dict(),  # keyword arguments of utils.get_agents_equal
+    max_steps=30,
+    reward_on_reference=True,
+    setting='BlackBoxSetting',
+    engine='pandas',
+    n_episodes=40000,
+    n_stats=400.0,
+    negative_reward=-1,
+    vectorized=False,
+    record_offers=False,  # record the offers of every step into the tape {run}offers
+)
+
+
+def experiment_dir(n_episodes, n_stats, buyers, sellers, q_learn_agents):
+    '''
+    Directory name of an experiment, as used by the playground notebooks.
+    '''
+    return f'{n_episodes}_{n_stats}_B{len(buyers)}_S{len(sellers)}_Q{len(q_learn_agents)}'
+
+
+def seed_job(seed):
+    '''
+    Seeds the Python and numpy global random states from one job seed, and returns a numpy
+    Generator for per-agent streams. The three streams are spawned from one SeedSequence, so
+    they are independent of each other and of the streams of the other seeds.
+    '''
+    py_seq, np_seq, agent_seq = np.random.SeedSequence(seed).spawn(3)
+    random.seed(int.from_bytes(py_seq.generate_state(4).tobytes(), 'little'))
+    np.random.seed(np_seq.generate_state(1)[0])
+    return np.random.default_rng(agent_seq)
+
+
+def dump_atomic(obj, path):
+    '''
+    Pickles obj into path through a temporary file in the same directory, so that path holds
+    either the previous or the complete new content.
+    '''
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def replace_dir(tmp_path, path):
+    '''
+    Moves the directory tmp_path to path. A previous directory at path is moved aside first and
+    removed after the move, so that path holds either a previous or a complete new directory.
+    '''
+    old_path = None
+    if os.path.exists(path):
+        old_path = tempfile.mkdtemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+        os.replace(path, os.path.join(old_path, os.path.basename(path)))
+    os.replace(tmp_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path)
+
+
+def run_job(config, seed, run, root='.'):
+    '''
+    Trains freshly created agents for one (config, seed) pair and writes
+    {run}buyers.pkl, {run}sellers.pkl and {run}steps.pkl into the experiment directory under root,
+    the statistics of every n_stats episodes into {run}metrics.csv, and the offer tape
+    {run}offers if config['record_offers'] is set.
+    The metrics and the tape are streamed into a temporary directory beside them and moved into
+    place when the training is complete, so a failed job leaves no partial run artifacts.
+    Returns the experiment directory.
+    '''
+    config = dict(DEFAULT_CONFIG, **config)
+    rng = seed_job(seed)
+    buyers, sellers, inequality, q_learn_agents = get_agents_equal(**config['agents'])
+    dir_path = os.path.join(root, experiment_dir(config['n_episodes'], config['n_stats'],
+                                                 buyers, sellers, q_learn_agents))
+    os.makedirs(dir_path, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=dir_path, prefix='.tmp-')
+    tmp_tape = os.path.join(tmp_dir, 'offers')
+    tmp_metrics = os.path.join(tmp_dir, 'metrics.csv')
+    tape = None
+    try:
+        if config['record_offers']:
+            tape = OfferTape(tmp_tape, [agent.agent_id for agent in sellers + buyers])
+        market_env = MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=config['max_steps'],
+                                       matcher=RandomMatcher(reward_on_reference=config['reward_on_reference']),
+                                       setting=getattr(info_settings, config['setting']),
+                                       engine=config['engine'], tape=tape)
+        # a worker process runs headless, the statistics go to the metrics file instead of stdout
+        steps_list = learn(market_env, buyers, sellers, q_learn_agents, config['n_episodes'],
+                           config['n_stats'], config['negative_reward'], inequality,
+                           vectorized=config['vectorized'], rng=rng,
+                           sink=MetricsSink(path=tmp_metrics),
+                           # pool workers run several jobs, the profile is named after the job
+                           profiler=EpisodeProfiler.from_env(
+                               label=f'{os.path.basename(dir_path)}_run{run}'))
+        if tape is not None:
+            tape.close()
+            replace_dir(tmp_tape, f'{dir_path}/{run}offers')
+        # the sink writes no file without a row of statistics
+        if os.path.exists(tmp_metrics):
+            os.replace(tmp_metrics, f'{dir_path}/{run}metrics.csv')
+    finally:
+        if tape is not None:
+            tape.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    dump_atomic(buyers, f'{dir_path}/{run}buyers.pkl')
+    dump_atomic(sellers, f'{dir_path}/{run}sellers.pkl')
+    dump_atomic(steps_list, f'{dir_path}/{run}steps.pkl')
+    return dir_path
+
+
+def run_experiments(configs, seeds, root='.', max_workers=None):
+    '''
+    Runs every config with every seed on a process pool, run i of a config uses seeds[i].
+    Each job trains its own agents, so a sweep over 5 seeds replaces the notebooks'
+    sequential `for i in range(5)` loop with 5 independent runs.
+    Returns the experiment directory of every job, in the order of (config, seed).
+    '''
+    dir_paths = []
+    for config in configs:
+        config = dict(DEFAULT_CONFIG, **config)
+        buyers, sellers, _, q_learn_agents = get_agents_equal(**config['agents'])
+        dir_paths.append(experiment_dir(config['n_episodes'], config['n_stats'],
+                                        buyers, sellers, q_learn_agents))
+    if len(set(dir_paths)) < len(dir_paths):
+        raise ValueError(f'Configs would write their runs into the same directory: {dir_paths}')
+
+    jobs = [(config, seed, run) for config in configs for run, seed in enumerate(seeds)]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_job, config, seed, run, root) for config, seed, run in jobs]
+        return [future.result() for future in futures]
@@ -0,0 +1,269 @@
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import info_settings
+from environments import STATE_MODES, MarketEnvironment
+from matchers import RandomMatcher
+from metrics import MetricsSink
+from phase_timer import PhaseTimer
+from runner import seed_job
+from utils import get_agents_equal, learn
+
+MISC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'misc')
+# engine name -> MarketEnvironment keyword arguments, as in benchmarks.ENGINES
+ENGINES = {
+    'pandas': dict(engine='pandas'),
+    'array': dict(engine='array'),
+    'array+book': dict(engine='array', order_book=True),
+}
+
+# The experiments of the report. The 3v3 black-box and grouped sellers experiments train RLlib
+# agents on the dmarket environment, here the same markets (3 sellers at 90, 3 buyers at 110,
+# 20 offers within 25% of the reservation price, black-box setting) are played by Q Learning
+# Agents of this package. The grouped sellers share one Q table, like the one policy of the
+# RLlib seller group.
+SCENARIOS = {
+    '4B3S1Q': dict(
+        kind='learn',
+        agents=dict(sellr_reserve=90, buyer_reserve=110, sellr_default=110, buyer_default=90,
+                    n_rnd_int_buyers=3, n_rnd_int_sellrs=3, n_q_learn_buyers=1,
+                    n_q_learn_sellrs=0, n_states=20),
+        hyperparameters=dict(alpha=0.1, gamma=0.95, epsilon=0.1),
+        max_steps=30, setting='BlackBoxSetting', n_episodes=1000),
+    '5v5_10Q': dict(
+        kind='learn',
+        agents=dict(),
+        hyperparameters=dict(),
+        max_steps=30, setting='BlackBoxSetting', n_episodes=2000),
+    '3v3_blackbox': dict(
+        kind='learn',
+        agents=dict(sellr_reserve=90, buyer_reserve=110, sellr_default=112.5, buyer_default=82.5,
+                    n_q_learn_buyers=3, n_q_learn_sellrs=3, n_states=20),
+        hyperparameters=dict(),
+        max_steps=30, setting='BlackBoxSetting', n_episodes=1000),
+    'grouped_sellers': dict(
+        kind='learn',
+        agents=dict(sellr_reserve=90, buyer_reserve=110, sellr_default=112.5, buyer_default=82.5,
+                    n_q_learn_buyers=3, n_q_learn_sellrs=3, n_states=20),
+        hyperparameters=dict(),
+        group_sellers=True,
+        max_steps=30, setting='BlackBoxSetting', n_episodes=1000),
+    'monte_carlo': dict(
+        kind='monte_carlo',
+        max_steps=10, setting='BlackBoxSetting', n_episodes=100),
+}
+
+
+def count_steps(market_env):
+    '''
+    Counts the steps of market_env, whichever step method is called, from the market time at
+    every reset. Returns a function that returns the number of steps so far.
+    '''
+    finished = [0]
+
+    def counted(reset):
+        def counted_reset():
+            finished[0] += market_env.time
+            return reset()
+        return counted_reset
+
+    market_env.reset = counted(market_env.reset)
+    market_env.reset_arrays = counted(market_env.reset_arrays)
+    return lambda: finished[0] + market_env.time
+
+
+def load_misc_agents():
+    '''
+    Imports misc/agents.py, the agents of the Monte Carlo train.py script, under a name that does
+    not collide with the agents module of this package.
+    '''
+    spec = importlib.util.spec_from_file_location('misc_agents', os.path.join(MISC_DIR, 'agents.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def play_learn(scenario, engine, state_mode, vectorized, rng, timer=None):
+    '''
+    Trains the Q Learning Agents of a scenario with utils.learn, timing its phases with timer.
+    Returns the market environment and its step count.
+    '''
+    buyers, sellers, inequality, q_learn_agents = get_agents_equal(**scenario['agents'])
+    for agent in q_learn_agents:
+        for name, value in scenario['hyperparameters'].items():
+            setattr(agent, name, value)
+    if scenario.get('group_sellers'):
+        # a QLearningPopulation keeps its own tables, so the group is only trained unvectorized
+        vectorized = False
+        q_sellers = [agent for agent in q_learn_agents if agent in sellers]
+        for agent in q_sellers[1:]:
+            agent.q_table = q_sellers[0].q_table
+    market_env = MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=scenario['max_steps'],
+                                   matcher=RandomMatcher(reward_on_reference=True),
+                                   setting=getattr(info_settings, scenario['setting']),
+                                   state_mode=state_mode, **ENGINES[engine])
+    steps = count_steps(market_env)
+    n_episodes = scenario['n_episodes']
+    learn(market_env, buyers, sellers, q_learn_agents, n_episodes, max(1, n_episodes // 10),
+          -1, inequality, vectorized=vectorized, rng=rng, timer=timer, sink=MetricsSink())
+    return market_env, steps()
+
+
+def play_monte_carlo(scenario, engine, state_mode):
+    '''
+    The episode loop of misc/train.py: 4 random sellers, 4 random buyers and the Monte Carlo
+    buyer 'Jarvis', which all read their state from the observations of the last step.
+    Returns the market environment and its step count.
+    '''
+    misc_agents = load_misc_agents()
+    names = ['Alice', 'Eve', 'John', 'Nick', 'Giannis', 'Joel', 'Ben', 'Furkan', 'Jarvis']
+    sellers = [misc_agents.Seller(name, 20) for name in names[:4]]
+    buyers = [misc_agents.Buyer(name, 100) for name in names[4:8]]
+    buyers.append(misc_agents.MonteCarlo_MarketAgent('Jarvis', 100,
+                                                     misc_agents.MarketAgent.get_random_offer,
+                                                     misc_agents.MarketAgent.get_random_offer_p))
+    agent_dict = dict((agent.agent_id, agent) for agent in sellers + buyers)
+    rl_agent = agent_dict['Jarvis']
+    market = MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=scenario['max_steps'],
+                               matcher=RandomMatcher(reward_on_reference=True),
+                               setting=getattr(info_settings, scenario['setting']),
+                               state_mode=state_mode, **ENGINES[engine])
+    steps = count_steps(market)
+
+    for _ in range(scenario['n_episodes']):
+        market.reset()
+        for agent in agent_dict.values():
+            agent.reset()
+        offers = dict((agent.agent_id, 100 if isinstance(agent, misc_agents.Seller) else 0)
+                      for agent in agent_dict.values())
+        for agent_id, offer in offers.items():
+            agent_dict[agent_id].actions.append(offer)
+        observations, rewards, _, _ = market.step(offers)
+        for agent_id, reward in rewards.items():
+            agent_dict[agent_id].total_rewards += reward
+            agent_dict[agent_id].rewards.append(reward)
+
+        while market.time < market.max_steps:
+            offers = {}
+            for agent_id, agent in agent_dict.items():
+                state = observations[agent_id][0]
+                if agent is rl_agent:
+                    offers[agent_id] = agent.b_policy(agent.behavior_buyer, state)
+                else:
+                    offers[agent_id] = misc_agents.MarketAgent.get_random_offer(agent, state)
+                if not market.done[agent_id]:
+                    agent.actions.append(offers[agent_id])
+            observations, rewards, _, _ = market.step(offers)
+            for agent_id, reward in rewards.items():
+                agent = agent_dict[agent_id]
+                if not agent.done:
+                    agent.total_rewards += reward
+                    agent.rewards.append(reward)
+                    if market.done[agent_id]:
+                        agent.set_done()
+    return market, steps()
+
+
+def run_scenario(name, engine='array', state_mode='eager', vectorized=False, n_episodes=None,
+                 seed=0, time_phases=False):
+    '''
+    Plays one scenario for a fixed episode budget and seed, and measures it.
+    Returns the number of episodes and steps, the wall time, episodes/sec, steps/sec and the peak
+    resident set size of the process in MiB. With time_phases the learn scenarios also return the
+    summary of a PhaseTimer over the phases of learn, which adds to the wall time.
+    '''
+    scenario = dict(SCENARIOS[name])
+    if n_episodes is not None:
+        scenario['n_episodes'] = n_episodes
+    rng = seed_job(seed)
+    timer = PhaseTimer() if time_phases and scenario['kind'] == 'learn' else None
+    start = time.perf_counter()
+    if scenario['kind'] == 'monte_carlo':
+        _, steps = play_monte_carlo(scenario, engine, state_mode)
+    else:
+        _, steps = play_learn(scenario, engine, state_mode, vectorized, rng, timer)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mib = peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+    result = dict(scenario=name, engine=engine, state_mode=state_mode,
+                  vectorized=bool(vectorized and scenario['kind'] == 'learn'
+                                  and not scenario.get('group_sellers')),
+                  seed=seed, episodes=scenario['n_episodes'], steps=steps,
+                  seconds=elapsed, episodes_per_sec=scenario['n_episodes'] / elapsed,
+                  steps_per_sec=steps / elapsed, peak_rss_mib=peak_rss_mib)
+    if timer is not None:
+        result['phases'] = timer.summary()
+    return result
+
+
+def run(scenarios=tuple(SCENARIOS), engines=tuple(ENGINES), state_mode='eager', vectorized=False,
+        n_episodes=None, seed=0, isolate=True, time_phases=False):
+    '''
+    Runs every scenario with every engine and returns the measurements as a dictionary with the
+    keys 'meta' and 'results'.
+    With isolate every run is played in a fresh spawned process, so that the peak RSS of a run is
+    not inflated by the runs before it.
+    '''
+    results = []
+    for name in scenarios:
+        for engine in engines:
+            args = (name, engine, state_mode, vectorized, n_episodes, seed, time_phases)
+            if isolate:
+                with ProcessPoolExecutor(max_workers=1,
+                                         mp_context=multiprocessing.get_context('spawn')) as pool:
+                    results.append(pool.submit(run_scenario, *args).result())
+            else:
+                results.append(run_scenario(*args))
+    meta = dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), python=sys.version.split()[0],
+                numpy=np.__version__, pandas=pd.__version__, platform=platform.platform(),
+                processor=platform.processor(), seed=seed, isolate=isolate,
+                time_phases=time_phases)
+    return dict(meta=meta, results=results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks of the report scenarios.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    # every scenario reads the offers of its agents from the states, 'none' returns no states
+    parser.add_argument('--state-mode', default='eager',
+                        choices=[mode for mode in STATE_MODES if mode != 'none'],
+                        help='state mode of the market environment')
+    parser.add_argument('--vectorized', action='store_true',
+                        help='train the Q Learning Agents as one QLearningPopulation')
+    parser.add_argument('--episodes', type=int, default=None,
+                        help='episode budget of every scenario, instead of the scenario default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false',
+                        help='play all runs in this process')
+    parser.add_argument('--time-phases', action='store_true',
+                        help='time the phases of learn with a PhaseTimer')
+    parser.add_argument('--output', default='scenario_benchmarks.json')
+    args = parser.parse_args(argv)
+
+    report = run(args.scenarios, args.engines, args.state_mode, args.vectorized, args.episodes,
+                 args.seed, args.isolate, args.time_phases)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for result in report['results']:
+        print(f"{result['scenario']:<17}{result['engine']:<12}episodes={result['episodes']:<7}"
+              f"steps={result['steps']:<8}{result['episodes_per_sec']:>10.1f} eps/s"
+              f"{result['steps_per_sec']:>12.1f} steps/s{result['peak_rss_mib']:>9.1f} MiB")
+        for phase, stats in result.get('phases', dict()).items():
+            print(f"    {phase:<17}{stats['total_ms']:>10.1f} ms{stats['share']:>8.1%}")
+
+
+if __name__ == '__main__':
+    main()
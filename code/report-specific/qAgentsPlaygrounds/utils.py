@@ -2,7 +2,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 from IPython.display import clear_output
 
-from QLearningAgents import QLearningBuyer, QLearningSeller
+from profiling import EpisodeProfiler
+
+from QLearningAgents import QLearningBuyer, QLearningSeller, QLearningPopulation
 from RandOfferAgents import RandOfferBuyer, RandOfferSeller
 from RandInterAgents import RandInterBuyer, RandInterSeller
 
@@ -10,10 +12,11 @@ def get_agents_equal(sellr_reserve = 20, buyer_reserve = 100,
                      sellr_default = 100, buyer_default = 20,
                      n_rnd_off_buyers = 0, n_rnd_off_sellrs = 0,
                      n_rnd_int_buyers = 0, n_rnd_int_sellrs = 0,
-                     n_q_learn_buyers = 5, n_q_learn_sellrs = 5):
+                     n_q_learn_buyers = 5, n_q_learn_sellrs = 5, n_states = 11):
     '''
     Return requested amount of buyers, sellers with equal reservation, default prices.
     Also return list of Q Learning Agents, used for training them.
+    n_states is the number of offers (states) of the Q Learning Agents.
     '''
     rnd_off_buyers = []
     rnd_off_sellrs = []
@@ -40,10 +43,10 @@ def get_agents_equal(sellr_reserve = 20, buyer_reserve = 100,
     
     #Q Learning Buyers
     for i in range(n_q_learn_buyers):
-        q_learn_buyers.append(QLearningBuyer(agent_id = f'B[q{i}]', reservation_price = buyer_reserve, default_price = buyer_default))
+        q_learn_buyers.append(QLearningBuyer(agent_id = f'B[q{i}]', reservation_price = buyer_reserve, default_price = buyer_default, n_states = n_states))
     #Q Learning Sellers
     for i in range(n_q_learn_sellrs):
-        q_learn_sellrs.append(QLearningSeller(agent_id = f'S[q{i}]', reservation_price = sellr_reserve, default_price = sellr_default))
+        q_learn_sellrs.append(QLearningSeller(agent_id = f'S[q{i}]', reservation_price = sellr_reserve, default_price = sellr_default, n_states = n_states))
 
     buyers = rnd_off_buyers + rnd_int_buyers + q_learn_buyers
     sellers = rnd_off_sellrs + rnd_int_sellrs + q_learn_sellrs
@@ -54,7 +57,7 @@ def get_agents_equal(sellr_reserve = 20, buyer_reserve = 100,
     
     return buyers, sellers, inequality, q_learn_agents
     
-def update_q_tables(q_learn_agents, done_dict, rewards_dict, negative_reward=0):
+def update_q_tables(q_learn_agents, done_dict, rewards_dict, negative_reward=0, positions=None):
     '''
     Updates the Q Table of each Q Learning Agent in environment.
     
@@ -62,15 +65,19 @@ def update_q_tables(q_learn_agents, done_dict, rewards_dict, negative_reward=0):
     Until the agent has a deal, get negative reward.
     When the agent has a deal, get the reward, as given by algorithm.
     After the agent has had a deal, do not change Q Table.
+
+    If positions is given, done_dict and rewards_dict are arrays indexed by agent position
+    and positions holds the market position of every agent.
     '''
-    for agent in q_learn_agents:
-        if(not done_dict[agent.agent_id]):
+    keys = [agent.agent_id for agent in q_learn_agents] if positions is None else list(positions)
+    for agent, key in zip(q_learn_agents, keys):
+        if(not done_dict[key]):
             agent.update_table(negative_reward)
         elif(not agent.done):
-            agent.update_table(rewards_dict[agent.agent_id])
+            agent.update_table(rewards_dict[key])
             agent.done = True
             
-def calculate_stats(agents, rewards_dict, agent_sum, n_stats, episode):
+def calculate_stats(agents, rewards_dict, agent_sum, n_stats, episode, verbose=True):
     '''
     Calculate and print statistics from the training/testing episodes
     
@@ -80,6 +87,8 @@ def calculate_stats(agents, rewards_dict, agent_sum, n_stats, episode):
     or:
     (Every other time) add the latest reward to cumulative reward
     since last averaging
+
+    The averages are only printed if verbose.
     '''
     for index, agent in enumerate(agents):
         reward = rewards_dict[agent.agent_id]
@@ -87,11 +96,12 @@ def calculate_stats(agents, rewards_dict, agent_sum, n_stats, episode):
             temp_reward = agent_sum[index] / n_stats
             agent.rewards.append(temp_reward)
             agent_sum[index] = reward
-            print(f'{agent.agent_id}: Rewards={temp_reward}')
+            if verbose:
+                print(f'{agent.agent_id}: Rewards={temp_reward}')
         else:
             agent_sum[index] += reward
             
-def calculate_steps(n_stats, episode, steps, steps_sum, steps_list):
+def calculate_steps(n_stats, episode, steps, steps_sum, steps_list, verbose=True):
     '''
     Calculate and print statistics from the training/testing episodes
     
@@ -101,13 +111,16 @@ def calculate_steps(n_stats, episode, steps, steps_sum, steps_list):
     or:
     (Every other time) add the latest reward to cumulative reward
     since last averaging
+
+    The average is only printed if verbose.
     '''
 
     if episode % n_stats == 0:
         steps_avg = steps_sum / n_stats
         steps_list.append(steps_avg)
         steps_sum = steps
-        print(f'Episode {episode}: Steps={steps_avg}')
+        if verbose:
+            print(f'Episode {episode}: Steps={steps_avg}')
         return steps_sum, steps_avg
     else:
         steps_sum += steps
@@ -169,79 +182,158 @@ def save_stats(agents, n_stats, steps_list, PATH):
     np.savetxt(f'{PATH}/stats.csv', stats, delimiter=',')
     
     
-def learn(market_env, buyers, sellers, q_learn_agents, n_episodes, n_stats, negative_reward, inequality):
+def learn(market_env, buyers, sellers, q_learn_agents, n_episodes, n_stats, negative_reward, inequality,
+          vectorized=False, rng=None, timer=None, sink=None, profiler=None):
     """
     Train given Agents by running n_episodes episodes
     with specified market environment, agents, and other statistics
+
+    An episode ends when the market reports it as terminated (no deal possible anymore)
+    or truncated (max_steps reached). inequality is not used anymore and kept for compatibility.
+
+    With vectorized=True the Q Learning Agents are trained as one QLearningPopulation,
+    which draws its random numbers from rng (default: numpy global) instead of the agents' own calls.
+
+    The market is stepped on agent positions (reset_arrays, step_arrays), dictionaries keyed by
+    agent id are only built for the agents' get_offer and the statistics.
+    The agents that are not in a QLearningPopulation read their offer from the states, so the
+    state mode 'none' is only accepted when all agents are trained vectorized.
+
+    With a PhaseTimer as timer the phases reset, get_offer, update_q_tables and stats of every
+    episode are timed, and match and get_state inside the market step. The histograms of the
+    last n_stats episodes are printed with the statistics, or logged into the sink as the columns
+    {phase}_{statistic} of PhaseTimer.summary. Without a timer nothing is timed.
+
+    With a MetricsSink as sink the run is headless: nothing is printed or cleared, the sink counts
+    the episodes and steps, and every n_stats episodes it logs a row with the episode, the average
+    steps, the average reward of every agent (keyed by agent id) and the throughput.
+
+    With an EpisodeProfiler as profiler its window of episodes is profiled. By default the
+    profiler is configured by the RLFM_PROFILE environment variable, e.g. RLFM_PROFILE=1000:1100.
     """
     assert q_learn_agents, 'No agents that can learn has been given. Use method evaluate instead. '
+    population = QLearningPopulation(q_learn_agents, rng=rng) if vectorized else None
+    other_agents = [agent for agent in buyers + sellers if population is None or agent not in q_learn_agents]
+    if other_agents and market_env.state_mode == 'none':
+        raise ValueError("learn reads the offers of the agents from the states, which the state "
+                         "mode 'none' does not return. Use the state mode 'eager' or 'lazy', or "
+                         "train all agents vectorized")
+    registry = market_env.registry
+    other_positions = registry.positions(agent.agent_id for agent in other_agents).tolist()
+    q_positions = registry.positions(agent.agent_id for agent in q_learn_agents)
+    offers = np.empty(len(registry))
     buyer_sum = np.zeros(len(buyers))
     seller_sum = np.zeros(len(sellers))
 
     steps_sum = 0
     steps_list = []
+    market_timer = market_env.timer
+    if timer is not None:
+        market_env.timer = timer
+    if profiler is None:
+        profiler = EpisodeProfiler.from_env()
+
+    # the timer of the market is restored, and the profile and metrics written, on errors too
+    try:
+        for i in range(1, n_episodes + 1):
+            if profiler is not None:
+                profiler.episode(i)
+            if timer is not None:
+                start = timer.clock()
+            state = market_env.reset_arrays()
+
+            all_done = market_env.terminated or market_env.truncated
+            # the last non-zero reward of every agent in this episode
+            reward = np.zeros(len(registry))
+
+            # Variable to store whether agent is done for Episode
+            for q_agent in q_learn_agents:
+                q_agent.done = False
+            if population is not None:
+                population.reset()
+            if timer is not None:
+                timer.lap('reset', start)
+
+            # Do as many steps as necessary for all agents
+            while not all_done:
+                if timer is not None:
+                    start = timer.clock()
+                #dictionary to hold offers in current step of the episode
+                step_offers = {}
+                # Get offers from agents, the states are the observations of the last market step
+                for agent, position in zip(other_agents, other_positions):
+                    f = state[position]
+                    agent.get_offer(f[0], step_offers, verbose=False)
+                registry.scatter(step_offers, out=offers)
+                if population is not None:
+                    offers[q_positions] = population.select_offers()
+                if timer is not None:
+                    timer.lap('get_offer', start)
+
+                # Market step
+                state, rewards, done, info = market_env.step_arrays(offers)
+
+                if timer is not None:
+                    start = timer.clock()
+
+                # Update q tables of q-learning agents
+                if population is None:
+                    update_q_tables(q_learn_agents, done, rewards, negative_reward, positions=q_positions)
+                else:
+                    population.update_tables_arrays(done[q_positions], rewards[q_positions], negative_reward)
+                if timer is not None:
+                    timer.lap('update_q_tables', start)
+
+                # Check whether more deals can be made
+                all_done = info['terminated'] or info['truncated']
+
+                # Gather all non-zero rewards
+                # (rewards from deals struck in this step of the episode)
+                # In the last iteration of loop: All deal rewards are captured
+                reward = np.where(rewards != 0, rewards, reward)
 
-    for i in range(1, n_episodes + 1):
-        state = market_env.reset()
-
-        all_done = all(market_env.done.values())
-        reward = {}
-        rewards = {}
-
-        # Variable to store whether agent is done for Episode
-        for q_agent in q_learn_agents:
-            q_agent.done = False
-
-        # Do as many steps as necessary for all agents
-        while not all_done:
-            #dictionary to hold offers in current step of the episode
-            step_offers = {}
-            # Get offers from agents
-            for agent in buyers + sellers:
-                f = market_env.setting.get_state(agent_id=agent.agent_id,
-                                         deal_history=market_env.deal_history,
-                                         agents=market_env.agents,
-                                         offers=market_env.offers)
-                agent.get_offer(f[0], step_offers, verbose=False)
-
-            # Market step
-            observations, rewards, done, _ = market_env.step(step_offers)
-
-            # Update q tables of q-learning agents
-            update_q_tables(q_learn_agents, done, rewards, negative_reward)
-
-            # Check whether all agents are done/or if more deals can be made
-            all_done = all(done.values())
-            if(inequality != 0):
-                # If unequal number of sellers and buyers exist, one agent will not be "done" even though Episode should end
-                done_count = 0
-                for is_done in done.values():
-                    if not is_done:
-                        done_count += 1
-                if(done_count == inequality):
-                    all_done = True
-
-            # Gather all non-zero rewards
-            # (rewards from deals struck in this step of the episode)
-            # In the last iteration of loop: All deal rewards are captured
-            for item in rewards.items():
-                if(item[1] != 0):
-                    temp = {item[0] : item[1]}
-                    reward.update(temp)
-
-        # Save only the deal-striking rewards from each episode.
-        rewards.update(reward)
-        # Clear output for better visibility
-        if i % n_stats == 0:
-            clear_output(wait = True)    
-        # Calculate Average number of steps per episode in the last n_stats episodes
-        steps_sum, steps_avg = calculate_steps(n_stats=n_stats, episode=i, steps=market_env.time,
-                                               steps_sum=steps_sum, steps_list=steps_list)
-        # Calculate Average rewards for buyers per episode in the last n_stats episodes
-        calculate_stats(agents=buyers, rewards_dict=rewards, agent_sum=buyer_sum,
-                        n_stats=n_stats, episode=i)
-        # Calculate Average rewards for sellers per episode in the last n_stats episodes
-        calculate_stats(agents=sellers, rewards_dict=rewards, agent_sum=seller_sum,
-                        n_stats=n_stats, episode=i)
+            if timer is not None:
+                start = timer.clock()
+            # Save only the deal-striking rewards from each episode.
+            rewards = registry.to_dict(reward)
+            verbose = sink is None
+            # Clear output for better visibility
+            if verbose and i % n_stats == 0:
+                clear_output(wait = True)    
+            # Calculate Average number of steps per episode in the last n_stats episodes
+            steps_sum, steps_avg = calculate_steps(n_stats=n_stats, episode=i, steps=market_env.time,
+                                                   steps_sum=steps_sum, steps_list=steps_list,
+                                                   verbose=verbose)
+            # Calculate Average rewards for buyers per episode in the last n_stats episodes
+            calculate_stats(agents=buyers, rewards_dict=rewards, agent_sum=buyer_sum,
+                            n_stats=n_stats, episode=i, verbose=verbose)
+            # Calculate Average rewards for sellers per episode in the last n_stats episodes
+            calculate_stats(agents=sellers, rewards_dict=rewards, agent_sum=seller_sum,
+                            n_stats=n_stats, episode=i, verbose=verbose)
+            if sink is not None:
+                sink.tick(market_env.time)
+            if timer is not None:
+                timer.lap('stats', start)
+            if i % n_stats == 0:
+                if sink is not None:
+                    row = dict(episode=i, steps=steps_avg)
+                    for agent in buyers + sellers:
+                        row[agent.agent_id] = agent.rewards[-1]
+                    if timer is not None:
+                        for phase, stats in timer.summary(window=True).items():
+                            row.update((f'{phase}_{name}', value) for name, value in stats.items())
+                    sink.log(row)
+                elif timer is not None:
+                    print(timer.report())
+                if timer is not None:
+                    timer.next_window()
+    finally:
+        if profiler is not None:
+            profiler.close()
+        market_env.timer = market_timer
+        if sink is not None:
+            sink.flush()
+    if population is not None:
+        population.sync()
     return steps_list
     
\ No newline at end of file
@@ -0,0 +1,375 @@
+import multiprocessing
+import random
+import traceback
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from environments import MarketEnvironment
+
+
+class VecMarketEnvironment:
+    def __init__(self, sellers: list, buyers: list, n_markets: int, max_steps: int, matcher,
+                 setting):
+        """
+        A vectorized market environment, which steps n_markets independent markets with the same
+        agents in lockstep. The market state is kept in 2-D arrays of shape (n_markets, n_agents),
+        the agent positions follow MarketEnvironment: sellers first, then buyers.
+        Markets are matched in row order with the matcher's match_batch, so stepping this
+        environment gives the same results as stepping n_markets MarketEnvironment objects one
+        after the other with the same offers.
+        A market is finished when it is terminated or truncated, as defined by
+        MarketEnvironment.step. Finished markets are reset automatically at the end of step.
+        :param sellers: A list containing all the agents that are extending the Seller agent
+        :param buyers: A list containing all the agents that are extending the Buyer agent
+        :param n_markets: the number of independent markets
+        :param max_steps: the maximum number of steps that runs for a round of a market, None
+        for rounds that only end when they are terminated
+        :param matcher: the matcher object, shared by all markets
+        :param setting: the information setting class, shared by all markets. Settings with a
+        history, e.g. OfferHistorySetting, are built once per market.
+        """
+        # the single market is only used for the agent information and the information setting
+        self.market = MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=max_steps,
+                                        matcher=matcher, setting=setting, engine='array')
+        self.agents = self.market.agents
+        self.agent_id_list = self.market.agent_id_list
+        self.is_buyer = self.market.is_buyer
+        self.res_prices = self.market.res_prices
+        self.matcher = matcher
+        self.setting = self.market.setting
+        # settings with a history keep the history of one market, every market gets its own
+        if self.market.records_offers:
+            self.settings = [setting(self.agents) for _ in range(n_markets)]
+        else:
+            self.settings = [self.setting] * n_markets
+        self.n_markets = n_markets
+        self.n_agents = len(self.agent_id_list)
+        self.obs_dim = self.market.reset_arrays().shape[1]
+        self.max_steps = max_steps
+
+        shape = (n_markets, self.n_agents)
+        self.offers = np.zeros(shape)
+        self.offer_times = np.zeros(shape, dtype=np.int64)
+        self.matched = np.zeros(shape, dtype=bool)
+        self.time = np.zeros(n_markets, dtype=np.int64)
+        self.deal_history = [list() for _ in range(n_markets)]
+        self.reset()
+
+    def step(self, actions: np.ndarray):
+        """
+        Steps all markets with one offer matrix.
+        :param actions: an array of shape (n_markets, n_agents) with the offer per market and
+        agent, NaN for agents that do not submit an offer
+        :return: a tuple of 4 objects: the observations of shape (n_markets, n_agents, obs_dim),
+        the rewards of shape (n_markets, n_agents), the done mask of shape (n_markets, n_agents)
+        and an info dictionary. The info contains the masks 'terminated' and 'truncated' over the
+        markets, 'market_done', the mask of markets that finished in this step,
+        'final_observations', the observations of the finished markets before they were reset,
+        and 'episode_steps', the number of steps of the finished markets.
+        The returned done mask and rewards are the ones of the step that finished a market, while
+        the observations of a finished market are the initial observations of its next round.
+        """
+        actions = np.asarray(actions, dtype=np.float64)
+        rewards, (markets, sellers, buyers, deal_prices) = self.matcher.match_batch(
+            actions=actions,
+            offers=self.offers,
+            times=self.offer_times,
+            is_buyer=self.is_buyer,
+            res_prices=self.res_prices,
+            matched=self.matched,
+            env_time=self.time
+        )
+        ids = self.agent_id_list
+        for market, seller, buyer, deal_price in zip(markets.tolist(), sellers.tolist(),
+                                                     buyers.tolist(), deal_prices.tolist()):
+            self.deal_history[market].append(dict(Seller=ids[seller], Buyer=ids[buyer],
+                                                  time=int(self.time[market]),
+                                                  deal_price=deal_price))
+        if self.market.records_offers:
+            for market, setting in enumerate(self.settings):
+                setting.record_offers(int(self.time[market]) + 1, self.offers[market])
+        observations = self._get_states(np.arange(self.n_markets))
+        done = self.matched.copy()
+        self.time += 1
+
+        # no deal is possible when the best unmatched buyer reservation price is below the best
+        # unmatched seller reservation price, an empty side gives -inf or inf
+        buyer_prices = np.where(~done & self.is_buyer, self.res_prices, -np.inf).max(axis=1)
+        seller_prices = np.where(~done & ~self.is_buyer, self.res_prices, np.inf).min(axis=1)
+        terminated = buyer_prices < seller_prices
+        truncated = ~terminated & (self.max_steps is not None and self.time >= self.max_steps)
+        market_done = terminated | truncated
+        info = dict(terminated=terminated, truncated=truncated, market_done=market_done,
+                    final_observations=observations[market_done],
+                    episode_steps=self.time[market_done])
+        if market_done.any():
+            observations[market_done] = self._reset_markets(np.flatnonzero(market_done))
+        return observations, rewards, done, info
+
+    def reset(self):
+        """
+        Resets all markets to an initial state.
+        :return: the initial observations of shape (n_markets, n_agents, obs_dim)
+        """
+        return self._reset_markets(np.arange(self.n_markets))
+
+    def _reset_markets(self, markets: np.ndarray):
+        self.offers[markets] = 0
+        self.offer_times[markets] = 0
+        self.matched[markets] = False
+        self.time[markets] = 0
+        for market in markets.tolist():
+            self.deal_history[market] = list()
+            if self.market.records_offers:
+                self.settings[market].start_round(self.max_steps)
+        return self._get_states(markets)
+
+    def _get_states(self, markets: np.ndarray):
+        # the setting writes the states of every market straight into the batch
+        states = np.empty((markets.shape[0], self.n_agents, self.obs_dim),
+                          dtype=self.setting.dtype)
+        for row, market in enumerate(markets.tolist()):
+            self.settings[market].get_states(self.deal_history[market], self.offers[market],
+                                             out=states[row])
+        return states
+
+    def market_offers(self, market: int):
+        """
+        Builds a DataFrame view of the offers of one market, in the layout of
+        MarketEnvironment.offers.
+        :param market: the row of the market
+        :return: a new DataFrame with one row per agent
+        """
+        frame = self.agents.copy()
+        frame['offer'] = self.offers[market]
+        frame['time'] = self.offer_times[market]
+        return frame
+
+
+def _attach_arrays(spec: dict):
+    """
+    Attaches to the shared memory blocks of spec.
+    :param spec: a dictionary of array name -> (block name, shape, dtype string)
+    :return: the list of blocks and a dictionary of array name -> array in its block
+    """
+    blocks, arrays = [], dict()
+    for name, (block_name, shape, dtype) in spec.items():
+        block = SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return blocks, arrays
+
+
+def _market_worker(conn, spec, start, stop, sellers, buyers, max_steps, matcher, setting, seed):
+    """
+    Runs markets start to stop of a SubprocVecMarketEnvironment in a VecMarketEnvironment.
+    The commands 'reset', 'step' and 'close' are received through conn, the arrays are read from
+    and written to the shared memory blocks, and every command is answered with None, or with
+    the traceback of an error.
+    """
+    blocks, arrays = _attach_arrays(spec)
+    try:
+        random.seed(seed)
+        np.random.seed(seed)
+        # every worker has a pickled copy of the matcher, its own rng would repeat the same draws
+        if getattr(matcher, 'rng', None) is not None:
+            matcher.rng = random.Random(seed)
+        env = VecMarketEnvironment(sellers=sellers, buyers=buyers, n_markets=stop - start,
+                                   max_steps=max_steps, matcher=matcher, setting=setting)
+        markets = slice(start, stop)
+        while True:
+            command = conn.recv()
+            if command == 'close':
+                break
+            try:
+                if command == 'reset':
+                    arrays['observations'][markets] = env.reset()
+                elif command == 'step':
+                    observations, rewards, done, info = env.step(arrays['actions'][markets])
+                    market_done = info['market_done']
+                    arrays['observations'][markets] = observations
+                    arrays['rewards'][markets] = rewards
+                    arrays['done'][markets] = done
+                    for key in ('terminated', 'truncated', 'market_done'):
+                        arrays[key][markets] = info[key]
+                    arrays['final_observations'][markets][market_done] = info['final_observations']
+                    arrays['episode_steps'][markets][market_done] = info['episode_steps']
+                else:
+                    raise ValueError(f"Unknown command '{command}'")
+                conn.send(None)
+            except Exception:
+                conn.send(traceback.format_exc())
+    finally:
+        # the arrays must be released before their blocks are closed
+        arrays.clear()
+        for block in blocks:
+            block.close()
+        conn.close()
+
+
+class SubprocVecMarketEnvironment:
+    def __init__(self, sellers: list, buyers: list, n_markets: int, max_steps: int, matcher,
+                 setting, n_workers: int = None, seed: int = None, start_method: str = None):
+        """
+        A vectorized market environment, which runs n_markets independent markets with the same
+        agents in n_workers processes. Every worker steps a contiguous slice of the markets in a
+        VecMarketEnvironment. The actions, observations, rewards and flags of all markets are
+        exchanged through arrays in shared memory, only the commands are sent through pipes.
+        step steps the markets synchronously, step_async and step_wait split it, so that other
+        work can be done while the workers step their markets.
+        The worker processes and the shared memory are released by close, or at the end of a
+        with block.
+        :param sellers: A list containing all the agents that are extending the Seller agent
+        :param buyers: A list containing all the agents that are extending the Buyer agent
+        :param n_markets: the number of independent markets
+        :param max_steps: the maximum number of steps that runs for a round of a market
+        :param matcher: the matcher object, copied to every worker
+        :param setting: the information setting class
+        :param n_workers: the number of worker processes, defaults to the number of CPUs
+        :param seed: the seed of the random states of the workers, each worker seeds the Python
+        and numpy global random states with its own seed spawned from this one. A matcher with
+        its own rng gets a random.Random of the worker seed instead of it in every worker, so
+        that the workers draw independent deal prices.
+        :param start_method: the multiprocessing start method, defaults to the platform default
+        """
+        self.market = MarketEnvironment(sellers=sellers, buyers=buyers, max_steps=max_steps,
+                                        matcher=matcher, setting=setting, engine='array')
+        self.agents = self.market.agents
+        self.agent_id_list = self.market.agent_id_list
+        self.is_buyer = self.market.is_buyer
+        self.res_prices = self.market.res_prices
+        self.n_markets = n_markets
+        self.n_agents = len(self.agent_id_list)
+        self.max_steps = max_steps
+        obs_dim = self.market.reset_arrays().shape[1]
+        n_workers = min(n_workers or multiprocessing.cpu_count(), n_markets)
+
+        shapes = dict(
+            actions=((n_markets, self.n_agents), np.float64),
+            observations=((n_markets, self.n_agents, obs_dim), self.market.setting.dtype),
+            rewards=((n_markets, self.n_agents), np.float64),
+            done=((n_markets, self.n_agents), bool),
+            terminated=((n_markets,), bool),
+            truncated=((n_markets,), bool),
+            market_done=((n_markets,), bool),
+            final_observations=((n_markets, self.n_agents, obs_dim), self.market.setting.dtype),
+            episode_steps=((n_markets,), np.int64),
+        )
+        self._blocks = []
+        self._arrays = dict()
+        spec = dict()
+        for name, (shape, dtype) in shapes.items():
+            dtype = np.dtype(dtype)
+            block = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+            self._blocks.append(block)
+            self._arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            spec[name] = (block.name, shape, dtype.str)
+
+        context = multiprocessing.get_context(start_method)
+        bounds = np.linspace(0, n_markets, n_workers + 1).astype(int).tolist()
+        seeds = np.random.SeedSequence(seed).generate_state(n_workers).tolist()
+        self._conns = []
+        self._processes = []
+        for start, stop, worker_seed in zip(bounds[:-1], bounds[1:], seeds):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_market_worker, daemon=True,
+                                      args=(child_conn, spec, start, stop, sellers, buyers,
+                                            max_steps, matcher, setting, worker_seed))
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._processes.append(process)
+        self._waiting = False
+        self.closed = False
+
+    def reset(self):
+        """
+        Resets all markets to an initial state.
+        :return: the initial observations of shape (n_markets, n_agents, obs_dim)
+        """
+        self._send('reset')
+        self._receive()
+        return self._arrays['observations'].copy()
+
+    def step(self, actions: np.ndarray):
+        """
+        Steps all markets with one offer matrix, see VecMarketEnvironment.step.
+        :param actions: an array of shape (n_markets, n_agents) with the offer per market and
+        agent, NaN for agents that do not submit an offer
+        :return: the observations, rewards, done mask and info, as VecMarketEnvironment.step
+        """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions: np.ndarray):
+        """
+        Hands the offers to the workers and returns without waiting for the step.
+        :param actions: an array of shape (n_markets, n_agents), see step
+        """
+        if self._waiting:
+            raise RuntimeError('step_async was called again before step_wait')
+        self._arrays['actions'][:] = actions
+        self._send('step')
+        self._waiting = True
+
+    def step_wait(self):
+        """
+        Waits for the step started by step_async.
+        :return: the observations, rewards, done mask and info, as VecMarketEnvironment.step
+        """
+        if not self._waiting:
+            raise RuntimeError('step_wait was called without step_async')
+        self._waiting = False
+        self._receive()
+        arrays = self._arrays
+        market_done = arrays['market_done'].copy()
+        info = dict(terminated=arrays['terminated'].copy(), truncated=arrays['truncated'].copy(),
+                    market_done=market_done,
+                    final_observations=arrays['final_observations'][market_done],
+                    episode_steps=arrays['episode_steps'][market_done])
+        return (arrays['observations'].copy(), arrays['rewards'].copy(), arrays['done'].copy(),
+                info)
+
+    def close(self):
+        """
+        Stops the workers and releases the shared memory.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._waiting:
+            self._receive()
+        for conn in self._conns:
+            try:
+                conn.send('close')
+            except (BrokenPipeError, EOFError, OSError):
+                pass
+        for process, conn in zip(self._processes, self._conns):
+            process.join()
+            conn.close()
+        self._arrays = dict()
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _send(self, command):
+        if self.closed:
+            raise RuntimeError('The environment is closed')
+        for conn in self._conns:
+            conn.send(command)
+
+    def _receive(self):
+        try:
+            errors = [conn.recv() for conn in self._conns]
+        except (EOFError, OSError) as error:
+            raise RuntimeError('A market worker exited unexpectedly') from error
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise RuntimeError('A market worker failed:\n' + errors[0])